@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Anomaly detection on dstat data with PCA: every sample is scored by
+Hotelling's T^2 (distance inside principal subspace) and SPE/Q statistic
+(squared reconstruction error, i.e. distance from it) against a baseline.
+Samples above thresholds (quantiles of baseline scores) are anomalous,
+consecutive ones are reported as intervals with the most deviating metrics.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from pca import PCA
+
+# Anomalous run of samples [start, end), peak scores and metrics contributing most to SPE
+Interval = namedtuple('Interval', 'start end t2 spe metrics')
+# Lowest threshold, scores are of standardized data and below it are rounding
+# noise, e.g. SPE of metrics which were constant in baseline
+MIN_THRESHOLD = 1e-6
+
+
+class Detector(object):
+    __doc__ = """
+    PCA based detector. Number of components is ``n_components`` or the
+    smallest one explaining ``variance`` of baseline.
+    """
+    def __init__(self, n_components=None, variance=0.9, quantile=0.995, top_metrics=3):
+        self.n_components = n_components
+        self.variance = variance
+        self.quantile = quantile
+        self.top_metrics = top_metrics
+
+    def fit(self, baseline):
+        """Fits scaling, PCA and thresholds on 2D baseline of normal workload"""
+        baseline = np.asarray(baseline, dtype=np.float64)
+        self.center = baseline.mean(axis=0)
+        std = baseline.std(axis=0)
+        self.scale = np.where(std > 0, std, 1)
+        data = (baseline - self.center) / self.scale
+        full = PCA(n_components=data.shape[1]).fit(data)
+        k = self.n_components or \
+            int(np.searchsorted(np.cumsum(full.explained_variance_ratio), self.variance) + 1)
+        self.model = PCA(n_components=min(k, data.shape[1])).fit(data)
+        t2, spe = self.score(baseline)
+        self.t2_threshold = max(np.percentile(t2, self.quantile * 100), MIN_THRESHOLD)
+        if len(self.model.components) < data.shape[1]:
+            self.spe_threshold = max(np.percentile(spe, self.quantile * 100), MIN_THRESHOLD)
+        else:
+            # All components are kept, residual is empty and SPE is noise
+            self.spe_threshold = np.inf
+        return self
+
+    def residuals(self, data):
+        """Returns (projection, residual) of scaled data"""
+        data = (np.asarray(data, dtype=np.float64) - self.center) / self.scale
+        projection = self.model.transform(data)
+        return projection, data - self.model.inverse_transform(projection)
+
+    def _scores(self, projection, residual):
+        variance = np.where(self.model.explained_variance > 0, self.model.explained_variance, 1)
+        return (projection ** 2 / variance).sum(axis=1), (residual ** 2).sum(axis=1)
+
+    def score(self, data):
+        """Returns (T^2, SPE) of every row of data"""
+        return self._scores(*self.residuals(data))
+
+    def detect(self, data, header):
+        """Returns list of anomalous Intervals of data"""
+        projection, residual = self.residuals(data)
+        t2, spe = self._scores(projection, residual)
+        flags = (t2 > self.t2_threshold) | (spe > self.spe_threshold)
+        # Starts and ends of runs of flagged samples
+        edges = np.diff(np.concatenate([[0], flags.astype(np.int8), [0]]))
+        starts, ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+        intervals = list()
+        for start, end in zip(starts, ends):
+            contribution = (residual[start:end] ** 2).sum(axis=0)
+            top = np.argsort(-contribution)[:self.top_metrics]
+            intervals.append(Interval(int(start), int(end), t2[start:end].max(), spe[start:end].max(),
+                                      [header[idx] for idx in top]))
+        return intervals
+
+
+if __name__ == '__main__':
+    import sys
+    from dstat_csv_parser import align, parse_files
+    # All given files form baseline, anomalies are reported per file
+    filenames = sys.argv[1:]
+    header, combined = align(parse_files(filenames))
+    hosts, data = combined[:, 0], np.nan_to_num(combined[:, 1:])
+    detector = Detector().fit(data)
+    print "components: {0}, T^2 threshold: {1:.2f}, SPE threshold: {2:.2f}".format(
+        len(detector.model.components), detector.t2_threshold, detector.spe_threshold)
+    for host, filename in enumerate(filenames):
+        for interval in detector.detect(data[hosts == host], header[1:]):
+            print "{0}: samples {1}-{2}, T^2 {3:.2f}, SPE {4:.2f}, metrics: {5}".format(
+                filename, interval.start, interval.end - 1, interval.t2, interval.spe, ", ".join(interval.metrics))
@@ -1,28 +1,343 @@
 #!/usr/bin/env python
+import os
+from collections import namedtuple
 from itertools import islice, izip, takewhile
 
+import numpy as np
 
-def parse_files(files):
-    fds = (open(file) for file in files)
-    return [parse_stream(fd) for fd in fds]
+from profiling import profiled
 
+# Parsed dstat file: comment rows, denormalized header, row since uptime, the rest of data
+# and unix time of its rows
+DstatData = namedtuple('DstatData', 'comments header startup data times')
+# Columns of ``-t`` and ``-T`` options, they are sample times rather than metrics
+TIME_COLUMNS = ('system/time', 'epoch/epoch')
 
-def parse_stream(stream):
-    import csv
-    rows = csv.reader(stream, delimiter=',', quotechar='"')
+
+def parse_header(rows):
+    """Returns (comments, header) consuming them from csv rows iterator"""
     # Strip dstat header
-    yield list(takewhile(bool, rows))
+    comments = list(takewhile(bool, rows))
     # Denormalize 2-row header
     hdr_rows = list(islice(rows, 0, 2))
     for i, value in enumerate(hdr_rows[0]):
         if not value:
             hdr_rows[0][i] = hdr_rows[0][i - 1]
-    yield ["/".join(x) for x in izip(*hdr_rows)]
+    return comments, ["/".join(x) for x in izip(*hdr_rows)]
+
+
+def parse_stream(stream):
+    import csv
+    rows = csv.reader(stream, delimiter=',', quotechar='"')
+    comments, header = parse_header(rows)
+    yield comments
+    yield header
     # Convert data to float
     # 1-st row is data since uptime
     for row in rows:
         yield [ float(value) for value in row ]
 
+
+def read_header_lines(stream):
+    """Reads lines up to and including 2-row header, keeping stream at data"""
+    lines = list()
+    for line in iter(stream.readline, ''):
+        lines.append(line)
+        if not line.strip():
+            break
+    lines.extend(stream.readline() for _ in xrange(2))
+    return lines
+
+
+def field_names(header):
+    """Makes header usable as structured array field names: dstat may repeat columns"""
+    names, seen = list(), dict()
+    for name in map(str, header):
+        seen[name] = seen.get(name, 0) + 1
+        names.append(name if seen[name] == 1 else "{0}#{1}".format(name, seen[name]))
+    return names
+
+
+def as_structured(data, header):
+    """Returns structured view with one named field per column"""
+    data = np.ascontiguousarray(data)
+    return data.view(np.dtype([(name, data.dtype) for name in field_names(header)])).reshape(-1)
+
+
+def comment(comments, key):
+    """Returns value of dstat comment field, e.g. 'Host:' or 'Date:'"""
+    for row in comments:
+        for idx in xrange(len(row) - 1):
+            if row[idx] == key:
+                return str(row[idx + 1])
+    return ''
+
+
+def parse_body(lines, header, dtype=np.float64):
+    """
+    Converts data lines to (metrics header, 2D array of metrics, dict of
+    time columns' values). Metrics are converted by NumPy in one pass.
+    """
+    lines = [line.strip() for line in lines if line.strip()]
+    skip = [idx for idx, name in enumerate(header) if name in TIME_COLUMNS]
+    clocks = dict()
+    if skip:
+        rows = [line.split(',') for line in lines]
+        keep = [idx for idx in xrange(len(header)) if idx not in skip]
+        for idx in skip:
+            clocks[header[idx]] = [row[idx].strip('"') for row in rows]
+        header = [header[idx] for idx in keep]
+        lines = [','.join(row[idx] for idx in keep) for row in rows]
+    values = np.fromstring(','.join(lines), dtype=dtype, sep=',')
+    # fromstring stops at the first empty or non-numeric field
+    if not header or values.size != len(lines) * len(header):
+        raise ValueError("Can't parse {0} rows of {1} columns, got {2} values".format(
+            len(lines), len(header), values.size))
+    return header, values.reshape(-1, len(header)), clocks
+
+
+def sample_times(comments, clocks, count):
+    """
+    Returns unix times of ``count`` rows: from ``-T`` column, from ``-t``
+    column (year is taken from 'Date:') or from 'Date:' and delay of
+    dstat's command line.
+    """
+    import calendar
+    import time
+    if 'epoch/epoch' in clocks:
+        return np.array(clocks['epoch/epoch'], dtype=np.float64)
+    date = comment(comments, 'Date:')
+    started = calendar.timegm(time.strptime(' '.join(date.split()[:4]), '%d %b %Y %H:%M:%S')) if date else 0
+    if 'system/time' in clocks:
+        year = time.gmtime(started).tm_year if date else time.gmtime().tm_year
+        days, times = dict(), list()
+        for value in clocks['system/time']:
+            day, clock = value.split(' ')
+            if day not in days:
+                days[day] = calendar.timegm(time.strptime('{0}-{1}'.format(year, day), '%Y-%d-%m'))
+            hours, minutes, seconds = clock.split(':')
+            times.append(days[day] + int(hours) * 3600 + int(minutes) * 60 + int(seconds))
+        return np.array(times, dtype=np.float64)
+    # dstat [options] [delay [count]]
+    numbers = [int(arg) for arg in comment(comments, 'Cmdline:').split()[1:] if arg.isdigit()]
+    delay = numbers[0] if numbers else 1
+    return started + delay * np.arange(count, dtype=np.float64)
+
+
+def load_stream(stream, dtype=np.float64):
+    """
+    Parses dstat CSV into DstatData with 2D array of ``dtype``. Body is
+    converted by NumPy in one pass instead of row by row.
+    """
+    import csv
+    comments, header = parse_header(csv.reader(read_header_lines(stream), delimiter=',', quotechar='"'))
+    header, data, clocks = parse_body(stream.read().splitlines(), header, dtype=dtype)
+    times = sample_times(comments, clocks, len(data))
+    return DstatData(comments, header, data[:1], data[1:], times[1:])
+
+
+def follow_file(filename, interval=1.0, dtype=np.float64):
+    """
+    Follows CSV dstat is still writing to, like ``tail -f``. Returns
+    (comments, header, batches) where batches yields 2D arrays of rows
+    appended since previous batch. Row since uptime is skipped.
+    """
+    import csv
+    import time
+    fd = open(filename)
+    comments, raw_header = parse_header(csv.reader(read_header_lines(fd), delimiter=',', quotechar='"'))
+    header = [name for name in raw_header if name not in TIME_COLUMNS]
+
+    def batches():
+        tail, startup = '', True
+        while True:
+            # stdio keeps EOF flag once it is hit (glibc >= 2.28), seeking
+            # clears it so rows appended since are read
+            fd.seek(fd.tell())
+            chunk = fd.read()
+            if not chunk:
+                time.sleep(interval)
+                continue
+            # Last line may be incomplete yet
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            if startup and lines:
+                lines, startup = lines[1:], False
+            values = parse_body(lines, raw_header, dtype=dtype)[1]
+            if values.size:
+                yield values
+    return comments, header, batches()
+
+
+def hostname(comments, default=''):
+    """Returns host name from dstat comment rows"""
+    return comment(comments, 'Host:') or default
+
+
+def reindex(result, header):
+    """Returns data with columns in order of (aligned) header, missing metrics are NaN"""
+    index = dict((name, idx) for idx, name in enumerate(field_names(result.header)))
+    data = np.full((len(result.data), len(header)), np.nan)
+    present = [(idx, index[name]) for idx, name in enumerate(header) if name in index]
+    if present:
+        columns, source = zip(*present)
+        data[:, list(columns)] = result.data[:, list(source)]
+    return data
+
+
+def cache_paths(filename):
+    return filename + '.npy', filename + '.hdr', filename + '.times.npy'
+
+
+def save_atomic(path, write):
+    """Writes file with ``write(fd)`` to temporary file renamed to ``path``, so it is never read torn"""
+    import tempfile
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            write(out)
+        os.rename(temp, path)
+    except Exception:
+        os.remove(temp)
+        raise
+
+
+def save_cache(filename, result):
+    """Writes sidecars of parsed file, failure (e.g. read-only directory) only disables cache"""
+    import json
+    import logging
+    data_path, header_path, times_path = cache_paths(filename)
+    try:
+        save_atomic(data_path, lambda fd: np.save(fd, np.concatenate([result.startup, result.data])))
+        save_atomic(times_path, lambda fd: np.save(fd, result.times))
+        save_atomic(header_path, lambda fd: json.dump(dict(comments=result.comments, header=result.header), fd))
+    except (IOError, OSError):
+        logging.warning("Can't cache {0}".format(filename), exc_info=True)
+
+
+@profiled
+def load_file(filename, dtype=np.float64, cache=False, structured=False):
+    """
+    Loads dstat CSV file. With ``cache`` parsed data is stored in ``.npy``
+    sidecar next to the file and memory-mapped on subsequent loads until the
+    CSV is modified. Sidecars are replaced atomically.
+    """
+    import json
+    data_path, header_path, times_path = cache_paths(filename)
+    result = None
+    if cache and all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filename)
+                     for path in cache_paths(filename)):
+        data = np.load(data_path, mmap_mode='r')
+        if data.dtype == dtype:
+            with open(header_path) as fd:
+                meta = json.load(fd)
+            result = DstatData(meta['comments'], meta['header'], data[:1], data[1:], np.load(times_path, mmap_mode='r'))
+    if result is None:
+        with open(filename) as fd:
+            result = load_stream(fd, dtype=dtype)
+        if cache:
+            save_cache(filename, result)
+    if structured:
+        result = result._replace(startup=as_structured(result.startup, result.header),
+                                 data=as_structured(result.data, result.header))
+    return result
+
+
+def parse_files(files, processes=None, dtype=np.float64, cache=False):
+    """
+    Loads files in worker processes, each of them keeps only one file open
+    at a time. Returns list of DstatData in order of files. Number of
+    processes and files per task default to --jobs and --batch-size.
+    """
+    from functools import partial
+    from runtime import RUNTIME
+    load = partial(load_file, dtype=dtype, cache=cache)
+    if (processes or RUNTIME.workers) == 1 or len(files) < 2:
+        return map(load, files)
+    pool = RUNTIME.pool(processes)
+    try:
+        return pool.map(load, files, chunksize=RUNTIME.batch(1))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def union_header(parsed):
+    """Returns (union of headers in order of appearance, index of metric in it)"""
+    header, index = list(), dict()
+    for result in parsed:
+        for name in field_names(result.header):
+            if name not in index:
+                index[name] = len(header)
+                header.append(name)
+    return header, index
+
+
+def align(parsed, dtype=np.float64):
+    """
+    Stacks data of all hosts into one matrix with host id (index in
+    ``parsed``) in the first column. Columns are union of all headers, so
+    files of different dstat versions can be combined, metrics missing on a
+    host are NaN. Returns (header, matrix).
+    """
+    header, index = union_header(parsed)
+    matrix = np.full((sum(len(result.data) for result in parsed), len(header) + 1), np.nan, dtype=dtype)
+    offset = 0
+    for host, result in enumerate(parsed):
+        rows = slice(offset, offset + len(result.data))
+        matrix[rows, 0] = host
+        matrix[rows, [index[name] + 1 for name in field_names(result.header)]] = result.data
+        offset = rows.stop
+    return ['host'] + header, matrix
+
+
+def resample(parsed, step=None, filename=None, dtype=np.float32):
+    """
+    Linearly interpolates every host onto common time grid with ``step``
+    (median sampling interval by default). Returns (grid, header, cube) where
+    cube is host x time x metric array, NaN outside of host's time range and
+    for metrics host doesn't have. With ``filename`` cube is memory-mapped
+    .npy file.
+    """
+    header, index = union_header(parsed)
+    series = [result for result in parsed if len(result.times)]
+    if not series:
+        raise ValueError("No samples to resample")
+    # Samples may be out of order, they are sorted per host below
+    if step is None:
+        step = float(np.median([np.median(np.diff(np.sort(result.times)))
+                                for result in series if len(result.times) > 1] or [1]))
+    start = min(np.min(result.times) for result in series)
+    end = max(np.max(result.times) for result in series)
+    grid = start + step * np.arange(int(np.floor((end - start) / step)) + 1)
+    shape = (len(parsed), len(grid), len(header))
+    if filename:
+        cube = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+    else:
+        cube = np.empty(shape, dtype=dtype)
+    cube.fill(np.nan)
+    for host, result in enumerate(parsed):
+        times, data = np.asarray(result.times), np.asarray(result.data)
+        if not len(times):
+            continue
+        if np.any(np.diff(times) < 0):
+            order = np.argsort(times, kind='mergesort')
+            times, data = times[order], data[order]
+        lo, hi = np.searchsorted(grid, times[0], 'left'), np.searchsorted(grid, times[-1], 'right')
+        points = grid[lo:hi]
+        # Neighbouring samples of every grid point and interpolation weights, all metrics at once
+        right = np.clip(np.searchsorted(times, points, 'right'), 1, max(len(times) - 1, 1))
+        left = right - 1 if len(times) > 1 else right * 0
+        right = np.minimum(right, len(times) - 1)
+        span = times[right] - times[left]
+        weight = np.where(span > 0, (points - times[left]) / np.where(span > 0, span, 1), 0)
+        values = data[left] + (data[right] - data[left]) * weight[:, np.newaxis]
+        cube[host, lo:hi][:, [index[name] for name in field_names(result.header)]] = values
+    if filename:
+        cube.flush()
+    return grid, header, cube
+
+
 if __name__ == '__main__':
     import fileinput
     print list(parse_stream(fileinput.input()))
@@ -1,47 +1,126 @@
 #!/usr/bin/env python
-import numpy as np
-import matplotlib.pyplot as plt
-from mdp.nodes import PCANode
-from itertools import izip
-from mpl_toolkits.mplot3d import Axes3D
+from opster import LazyCommand, lazy_import
+from profiling import profiled
+from runtime import RUNTIME, dispatcher
+
+# NumPy is imported only by commands, not by --help and completion
+np = lazy_import('numpy')
 
 def normalize(array):
-    """Normalizes array row by row"""
-    for row in array:
-        mean = np.mean(row)
-        std = np.std(row)
-        row -= mean
-        row /= std
-    return array
+    """Normalizes array in place metric by metric (column by column)"""
+    from scaling import zscore
+    return zscore(array, axis=0, inplace=True)
 
 def pca(multidim_data, output_dim):
     """Principal Component Analysis"""
-    pcanode = PCANode(input_dim=multidim_data.shape[1], output_dim=output_dim, dtype=np.float32,
-                      svd=True, reduce=True, var_rel=1E-15, var_abs=1E-15)
-    pcanode.train(data)
-    return np.dot(multidim_data, pcanode.get_projmatrix())
+    from pca import PCA
+    return PCA(n_components=output_dim).fit_transform(multidim_data)
 
-if __name__ == '__main__':
+def track(filename, output_dim=2, forgetting=0.999, interval=1.0):
+    """
+    Follows dstat CSV as it grows, yields (rows, projection) of every new
+    batch of rows. Model is updated incrementally, history is not kept.
+    """
+    from dstat_csv_parser import follow_file
+    from pca import IncrementalPCA
+    from scaling import RunningStats
+    comments, header, batches = follow_file(filename, interval=interval)
+    stats, model = RunningStats(len(header)), IncrementalPCA(n_components=output_dim, forgetting=forgetting)
+    for rows in batches:
+        data = stats.update(rows).transform(rows)
+        yield rows, model.partial_fit(data).transform(data)
+
+@profiled
+def score_host(filename, detector, header, cache=False):
+    """Returns (filename, host, samples, flagged samples, anomaly score) of one host"""
+    from dstat_csv_parser import hostname, load_file, reindex
+    result = load_file(filename, cache=cache)
+    data = reindex(result, header)
+    # Metrics unknown to host are taken as baseline mean
+    data = np.where(np.isnan(data), detector.center, data)
+    t2, spe = detector.score(data)
+    ratio = np.maximum(t2 / detector.t2_threshold, spe / detector.spe_threshold)
+    return filename, hostname(result.comments, filename), len(data), int((ratio > 1).sum()), \
+        float(ratio.mean()) if len(ratio) else 0.0
+
+def fleet(filenames, sample_size=20, processes=None, seed=0, cache=False):
+    """
+    Fits one baseline on random sample of hosts and scores every host
+    against it in worker processes. Returns score_host() rows, most
+    anomalous hosts first. With ``cache`` parsed files are kept in ``.npy``
+    sidecars.
+    """
+    import random
+    from functools import partial
+    from dstat_csv_parser import align, parse_files
+    from dstat_anomaly_detection import Detector
+    sample = random.Random(seed).sample(filenames, min(sample_size, len(filenames)))
+    header, combined = align(parse_files(sample, processes=processes, cache=cache))
+    baseline = combined[:, 1:]
+    baseline = np.where(np.isnan(baseline), np.nanmean(baseline, axis=0), baseline)
+    detector = Detector().fit(baseline)
+    pool = RUNTIME.pool(processes)
+    try:
+        rows = list(pool.imap_unordered(partial(score_host, detector=detector, header=header[1:], cache=cache), filenames,
+                                        chunksize=RUNTIME.batch(1)))
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(rows, key=lambda row: row[4], reverse=True)
+
+cli = dispatcher({
+    'store': LazyCommand('dstat_store:store_cmd', 'Append dstat CSV files to columnar store'),
+})
+
+@cli.command(name='fleet', usage='[OPTIONS] FILE...')
+def fleet_cmd(sample=('s', 20, 'number of hosts baseline is fitted on'),
+              seed=('', 0, 'random seed of host sample'),
+              cache=('', False, 'keep parsed files in .npy sidecars next to them for next runs'),
+              *filenames):
+    """Rank hosts by anomaly score against baseline of a sample of them"""
+    print "{0:<30} {1:>8} {2:>8} {3:>8}".format('host', 'samples', 'flagged', 'score')
+    for filename, host, samples, flagged, score in fleet(list(filenames), sample_size=sample, seed=seed, cache=cache):
+        print "{0:<30} {1:>8} {2:>8} {3:>8.3f}".format(host, samples, flagged, score)
+
+@cli.command(name='follow')
+def follow_cmd(filename,
+               forgetting=('f', 0.999, 'weight of old samples is multiplied by it for every new one'),
+               interval=('i', 1.0, 'seconds between checks for new rows')):
+    """Print projection of every new row of growing dstat CSV"""
     import sys
-    from dstat_csv_parser import parse_files
-    from itertools import islice, imap
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    parsed_files = parse_files(sys.argv[1:])
-    for f_id, parsed_data in enumerate(parsed_files):
-        comments, header, startup = islice(parsed_data, 3)
-        unnormalized_data = np.array(list(parsed_data))
-        data = normalize(np.copy(unnormalized_data))
-        projection = pca(data, output_dim=2)
-        a = ax.scatter(projection[:,0], projection[:,1], s=20, c=xrange(projection.shape[0]), marker='o')
-        for idx, row in enumerate(unnormalized_data):
-            xy = projection[idx, :] + 0.0025
-            #annotation = ''
-            #for hdr in izip(header, imap(str, row)):
-                #annotation += ":".join(hdr) + " "
-            #print idx, " ", annotation
-            import random
-            if random.randint(0,10) == 0:
-                plt.annotate(str(f_id), xy=xy)
-    plt.show()
+    for rows, projection in track(filename, forgetting=forgetting, interval=interval):
+        for point in projection:
+            print " ".join("{0:.4f}".format(value) for value in point)
+        sys.stdout.flush()
+
+@cli.command(name='plot', usage='[OPTIONS] FILE...')
+def plot_cmd(output=('o', 'dstat_pca.png', 'PNG or SVG file to render projection to'),
+             cache=('', False, 'keep parsed files in .npy sidecars next to them for next runs'),
+             *filenames):
+    """Plot projection of all hosts with anomalous samples annotated"""
+    from dstat_csv_parser import align, parse_files
+    from dstat_anomaly_detection import Detector
+    from dstat_plot import render
+    from pca import PCA
+
+    filenames = list(filenames)
+    # Fit once on all hosts, so their projections are comparable
+    header, combined = align(parse_files(filenames, cache=cache))
+    hosts = combined[:, 0]
+    data = normalize(np.nan_to_num(combined[:, 1:]))
+    model = PCA(n_components=2).fit(data)
+    projection = model.transform(data)
+    # Only anomalous samples are annotated, with host and sample number
+    detector = Detector().fit(data)
+    t2, spe = detector.score(data)
+    ratio = np.maximum(t2 / detector.t2_threshold, spe / detector.spe_threshold)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(hosts.astype(np.int64), minlength=len(filenames)))])
+    anomalies = [(projection[idx, 0], projection[idx, 1],
+                  "{0}:{1}".format(int(hosts[idx]), idx - offsets[int(hosts[idx])]), ratio[idx])
+                 for idx in np.nonzero(ratio > 1)[0]]
+    render([projection[hosts == f_id] for f_id in xrange(len(filenames))], output,
+           labels=filenames, anomalies=anomalies)
+    print "Saved {0}".format(output)
+
+if __name__ == '__main__':
+    cli.dispatch()
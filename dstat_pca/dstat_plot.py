@@ -1,3 +1,58 @@
 #!/usr/bin/env python
+"""
+Headless rendering of 2D projections to PNG/SVG (format is chosen by
+extension) with matplotlib's Agg backend. Dense point clouds are binned
+into density raster with NumPy before drawing, only anomalies are
+annotated, so rendering time doesn't grow with number of samples.
+"""
+import numpy as np
 
+# Above this number of points density raster is drawn instead of scatter
+MAX_POINTS = 10000
+# Annotations of the most anomalous points only
+MAX_ANNOTATIONS = 50
 
+
+def extent(projections):
+    """Returns (xmin, xmax, ymin, ymax) covering all projections"""
+    points = np.concatenate([projection[:, :2] for projection in projections])
+    (xmin, ymin), (xmax, ymax) = points.min(axis=0), points.max(axis=0)
+    # Degenerate ranges break histogram and imshow
+    return xmin, max(xmax, xmin + 1e-9), ymin, max(ymax, ymin + 1e-9)
+
+
+def density(projections, bins=256):
+    """Returns (counts, extent) of 2D histogram of all projections"""
+    limits = extent(projections)
+    counts = np.zeros((bins, bins))
+    for projection in projections:
+        counts += np.histogram2d(projection[:, 0], projection[:, 1], bins=bins,
+                                 range=[limits[:2], limits[2:]])[0]
+    return counts, limits
+
+
+def render(projections, filename, labels=None, anomalies=(), bins=256, max_points=MAX_POINTS):
+    """
+    Renders list of per-host projections to filename. ``anomalies`` are
+    (x, y, text, score) tuples, the highest scored are annotated.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    if sum(len(projection) for projection in projections) <= max_points:
+        for idx, projection in enumerate(projections):
+            ax.scatter(projection[:, 0], projection[:, 1], s=20, marker='o',
+                       label=labels[idx] if labels else None)
+        if labels:
+            ax.legend(loc='best', fontsize='small')
+    else:
+        counts, limits = density(projections, bins=bins)
+        image = ax.imshow(np.log1p(counts.T), extent=limits, origin='lower', aspect='auto', cmap='viridis')
+        fig.colorbar(image, ax=ax, label='log(1 + samples)')
+    for x, y, text, _ in sorted(anomalies, key=lambda anomaly: anomaly[3], reverse=True)[:MAX_ANNOTATIONS]:
+        ax.annotate(text, xy=(x, y), xytext=(3, 3), textcoords='offset points', fontsize='x-small', color='red')
+    fig.savefig(filename)
+    plt.close(fig)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Columnar on-disk store of dstat history, so loading weeks of data is I/O
+rather than parse bound.
+
+Layout::
+
+    <root>/<host>/schema.json                  metrics and partitions index
+    <root>/<host>/<partition start>/time.f64   unix times of rows
+    <root>/<host>/<partition start>/<N>.f32    raw float32 column of metric N
+
+Rows are partitioned by time (one day per partition by default). Columns are
+plain arrays appended to files, so they are read with ``np.memmap`` without
+any parsing. Metrics which appeared later are NaN in older rows.
+"""
+import json
+import os
+
+import numpy as np
+
+from dstat_csv_parser import DstatData, field_names
+from runtime import dispatcher
+
+# Seconds of data per partition
+CHUNK_SECONDS = 86400
+TIME_DTYPE = np.float64
+METRIC_DTYPE = np.float32
+
+
+def truncate(path, size):
+    """Cuts file down to ``size`` bytes if it is longer"""
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, 'r+b') as fd:
+            fd.truncate(size)
+
+
+class DstatStore(object):
+    __doc__ = """Time partitioned per-metric float32 columns of every host under ``root``"""
+    def __init__(self, root, chunk_seconds=CHUNK_SECONDS):
+        self.root = root
+        self.chunk_seconds = chunk_seconds
+
+    def hosts(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(host for host in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, host, 'schema.json')))
+
+    def schema(self, host):
+        """Returns host's schema: metrics and partitions with their rows and time range"""
+        path = os.path.join(self.root, host, 'schema.json')
+        if not os.path.exists(path):
+            return dict(metrics=list(), partitions=dict())
+        with open(path) as fd:
+            return json.load(fd)
+
+    def _save_schema(self, host, schema):
+        path = os.path.join(self.root, host, 'schema.json')
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(schema, fd, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def _column(self, host, partition, idx):
+        name = 'time.f64' if idx is None else '{0}.f32'.format(idx)
+        return os.path.join(self.root, host, str(partition), name)
+
+    def append(self, host, header, times, data):
+        """
+        Appends rows of 2D ``data`` with unix ``times`` to host's history.
+        Rows are committed by saving schema after all columns are written,
+        rows past committed ones are left by interrupted append and cut off.
+        Rows not later than the last stored one of their partition are
+        skipped, so a CSV dstat still appends to can be converted again.
+        """
+        times = np.asarray(times, dtype=TIME_DTYPE)
+        data = np.asarray(data, dtype=METRIC_DTYPE)
+        if not len(times):
+            return
+        schema = self.schema(host)
+        metrics = schema['metrics']
+        index = dict((name, idx) for idx, name in enumerate(metrics))
+        names = field_names(header)
+        for name in names:
+            if name not in index:
+                index[name] = len(metrics)
+                metrics.append(name)
+        columns = [index[name] for name in names]
+        partitions = (times // self.chunk_seconds * self.chunk_seconds).astype(np.int64)
+        for partition in np.unique(partitions):
+            rows = partitions == partition
+            key = str(partition)
+            info = schema['partitions'].setdefault(key, dict(rows=0, first=None, last=None))
+            if info['last'] is not None:
+                rows &= times > info['last']
+                if not rows.any():
+                    continue
+            directory = os.path.join(self.root, host, key)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = self._column(host, key, None)
+            truncate(path, info['rows'] * TIME_DTYPE().itemsize)
+            with open(path, 'ab') as fd:
+                fd.write(times[rows].tobytes())
+            chunk = data[rows]
+            present = dict(zip(columns, range(len(columns))))
+            for idx in xrange(len(metrics)):
+                path = self._column(host, key, idx)
+                truncate(path, info['rows'] * METRIC_DTYPE().itemsize)
+                written = os.path.getsize(path) // METRIC_DTYPE().itemsize if os.path.exists(path) else 0
+                with open(path, 'ab') as fd:
+                    # Metric is new to partition or absent in this batch
+                    if written < info['rows']:
+                        fd.write(np.full(info['rows'] - written, np.nan, dtype=METRIC_DTYPE).tobytes())
+                    if idx in present:
+                        fd.write(np.ascontiguousarray(chunk[:, present[idx]]).tobytes())
+                    else:
+                        fd.write(np.full(len(chunk), np.nan, dtype=METRIC_DTYPE).tobytes())
+            info['rows'] += int(rows.sum())
+            first, last = float(times[rows].min()), float(times[rows].max())
+            info['first'] = first if info['first'] is None else min(info['first'], first)
+            info['last'] = last if info['last'] is None else max(info['last'], last)
+        self._save_schema(host, schema)
+
+    def read(self, host, start=None, end=None, metrics=None):
+        """
+        Returns DstatData of host's rows with start <= time < end, columns
+        are memory-mapped and only partitions overlapping the range are read.
+        """
+        schema = self.schema(host)
+        header = [str(name) for name in metrics or schema['metrics']]
+        index = dict((name, idx) for idx, name in enumerate(schema['metrics']))
+        times, blocks = list(), list()
+        for key, info in sorted(schema['partitions'].items(), key=lambda item: int(item[0])):
+            if not info['rows'] or (start is not None and info['last'] < start) or \
+                    (end is not None and info['first'] >= end):
+                continue
+            partition_times = np.memmap(self._column(host, key, None), dtype=TIME_DTYPE, mode='r', shape=(info['rows'],))
+            rows = np.ones(info['rows'], dtype=bool)
+            if start is not None:
+                rows &= partition_times >= start
+            if end is not None:
+                rows &= partition_times < end
+            block = np.full((int(rows.sum()), len(header)), np.nan, dtype=METRIC_DTYPE)
+            for column, name in enumerate(header):
+                path = self._column(host, key, index[name]) if name in index else None
+                if path is None or not os.path.exists(path):
+                    continue
+                values = np.memmap(path, dtype=METRIC_DTYPE, mode='r')
+                # Only interrupted append leaves column shorter than partition
+                values = np.concatenate([values, np.full(info['rows'] - len(values), np.nan, dtype=METRIC_DTYPE)]) \
+                    if len(values) < info['rows'] else values[:info['rows']]
+                block[:, column] = values[rows]
+            times.append(np.asarray(partition_times[rows]))
+            blocks.append(block)
+        times = np.concatenate(times) if times else np.array([], dtype=TIME_DTYPE)
+        data = np.concatenate(blocks) if blocks else np.empty((0, len(header)), dtype=METRIC_DTYPE)
+        order = np.argsort(times, kind='mergesort')
+        return DstatData([['Host:', host]], list(header), data[:0], data[order], times[order])
+
+    def read_fleet(self, start=None, end=None, metrics=None):
+        """Returns DstatData of every host, e.g. for ``resample()``"""
+        return [self.read(host, start, end, metrics) for host in self.hosts()]
+
+
+def convert(store, filenames):
+    """Appends dstat CSV files to store, host names are taken from files"""
+    from dstat_csv_parser import hostname, load_file
+    for filename in filenames:
+        result = load_file(filename)
+        store.append(hostname(result.comments, os.path.basename(filename)), result.header, result.times, result.data)
+
+
+cli = dispatcher()
+
+@cli.command(name='store', usage='[OPTIONS] STORE FILE...')
+def store_cmd(root, *filenames):
+    """Append dstat CSV files to columnar store"""
+    convert(DstatStore(root), filenames)
+
+
+if __name__ == '__main__':
+    store_cmd.command()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Principal Component Analysis on NumPy alone.
+
+Exact SVD is used for small inputs, eigendecomposition of covariance matrix
+for long and narrow ones (usual dstat case: many samples of a few dozens of
+metrics) and randomized SVD (Halko, Martinsson, Tropp) for long and wide ones.
+Fitted model can be saved and used to project data of other hosts.
+``IncrementalPCA`` keeps only mean and scatter matrix of data seen so far and
+is updated batch by batch, e.g. while dstat appends rows to its CSV.
+"""
+
+import numpy as np
+
+
+def randomized_svd(array, k, oversample=10, n_iter=4, random_state=0):
+    """Returns (singular values, right singular vectors) of top ``k`` components"""
+    rnd = np.random.RandomState(random_state)
+    q = np.dot(array, rnd.normal(size=(array.shape[1], min(k + oversample, min(array.shape)))))
+    q, _ = np.linalg.qr(q)
+    # Power iterations sharpen spectrum, QR keeps them numerically stable
+    for _ in xrange(n_iter):
+        q, _ = np.linalg.qr(np.dot(array.T, q))
+        q, _ = np.linalg.qr(np.dot(array, q))
+    _, s, vt = np.linalg.svd(np.dot(q.T, array), full_matrices=False)
+    return s[:k], vt[:k]
+
+
+class PCA(object):
+    __doc__ = """
+    PCA with ``n_components`` components, ``method`` is one of 'auto',
+    'exact', 'covariance' or 'randomized'
+    """
+    def __init__(self, n_components=2, method='auto', dtype=np.float64, random_state=0):
+        self.n_components = n_components
+        self.method = method
+        self.dtype = dtype
+        self.random_state = random_state
+
+    def _method(self, n, d):
+        if self.method != 'auto':
+            return self.method
+        if n > 10 * d and d <= 2000:
+            return 'covariance'
+        if min(n, d) > 500 and self.n_components < min(n, d) / 4:
+            return 'randomized'
+        return 'exact'
+
+    def fit(self, array):
+        array = np.asarray(array, dtype=self.dtype)
+        n, d = array.shape
+        k = min(self.n_components, n, d)
+        self.mean = array.mean(axis=0)
+        centered = array - self.mean
+        method = self._method(n, d)
+        if method == 'covariance':
+            eigenvalues, eigenvectors = np.linalg.eigh(np.dot(centered.T, centered))
+            order = np.argsort(eigenvalues)[::-1][:k]
+            variance = np.maximum(eigenvalues[order], 0) / max(n - 1, 1)
+            components = eigenvectors[:, order].T
+        else:
+            if method == 'randomized':
+                s, components = randomized_svd(centered, k, random_state=self.random_state)
+            elif method == 'exact':
+                _, s, components = np.linalg.svd(centered, full_matrices=False)
+                s, components = s[:k], components[:k]
+            else:
+                raise ValueError("Unknown PCA method: {0}".format(method))
+            variance = s ** 2 / max(n - 1, 1)
+        self.components = components
+        self.explained_variance = variance
+        self.total_variance = (centered ** 2).sum() / max(n - 1, 1)
+        self.explained_variance_ratio = variance / self.total_variance if self.total_variance else variance * 0
+        self.n_samples = n
+        return self
+
+    def transform(self, array):
+        """Projects rows of array onto components"""
+        return np.dot(np.asarray(array) - self.mean, self.components.T)
+
+    def fit_transform(self, array):
+        return self.fit(array).transform(array)
+
+    def inverse_transform(self, projection):
+        """Maps projection back to original space"""
+        return np.dot(projection, self.components) + self.mean
+
+    def save(self, filename):
+        """Saves fitted model to .npz file"""
+        np.savez(filename, mean=self.mean, components=self.components,
+                 explained_variance=self.explained_variance, total_variance=self.total_variance,
+                 n_samples=self.n_samples)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads model saved with ``save``"""
+        saved = np.load(filename)
+        model = cls(n_components=len(saved['components']))
+        model.mean = saved['mean']
+        model.components = saved['components']
+        model.explained_variance = saved['explained_variance']
+        model.total_variance = float(saved['total_variance'])
+        model.explained_variance_ratio = model.explained_variance / model.total_variance \
+            if model.total_variance else model.explained_variance * 0
+        model.n_samples = int(saved['n_samples'])
+        return model
+
+
+class IncrementalPCA(PCA):
+    __doc__ = """
+    PCA updated batch by batch in O(features ** 2) memory. Weight of old
+    samples is multiplied by ``forgetting`` for every new one, so with
+    forgetting < 1 projection follows current workload.
+    """
+    def __init__(self, n_components=2, forgetting=1.0, dtype=np.float64):
+        super(IncrementalPCA, self).__init__(n_components=n_components, method='covariance', dtype=dtype)
+        self.forgetting = forgetting
+        self.weight = 0.0
+        self.mean = None
+        self.scatter = None
+        self.n_samples = 0
+
+    def partial_fit(self, batch):
+        """Adds rows of 2D batch to the model"""
+        batch = np.atleast_2d(np.asarray(batch, dtype=self.dtype))
+        n = len(batch)
+        if not n:
+            return self
+        if self.mean is None:
+            self.mean = np.zeros(batch.shape[1])
+            self.scatter = np.zeros((batch.shape[1], batch.shape[1]))
+        decay = self.forgetting ** n
+        batch_mean = batch.mean(axis=0)
+        centered = batch - batch_mean
+        old_weight = self.weight * decay
+        self.weight = old_weight + n
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * (n / self.weight)
+        self.scatter = self.scatter * decay + np.dot(centered.T, centered) + \
+            np.outer(delta, delta) * (old_weight * n / self.weight)
+        self.n_samples += n
+        self._update_components()
+        return self
+
+    def fit(self, array):
+        self.weight, self.mean, self.scatter, self.n_samples = 0.0, None, None, 0
+        return self.partial_fit(array)
+
+    def _update_components(self):
+        k = min(self.n_components, len(self.mean))
+        eigenvalues, eigenvectors = np.linalg.eigh(self.scatter)
+        order = np.argsort(eigenvalues)[::-1][:k]
+        # Sign of eigenvectors is arbitrary, fix it so projection doesn't flip between updates
+        components = eigenvectors[:, order].T
+        components *= np.where(components[np.arange(k), np.abs(components).argmax(axis=1)] < 0, -1, 1)[:, np.newaxis]
+        denominator = max(self.weight - 1, 1)
+        self.components = components
+        self.explained_variance = np.maximum(eigenvalues[order], 0) / denominator
+        self.total_variance = np.trace(self.scatter) / denominator
+        self.explained_variance_ratio = self.explained_variance / self.total_variance \
+            if self.total_variance else self.explained_variance * 0
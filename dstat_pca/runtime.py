@@ -0,0 +1 @@
+../network_graph/runtime.py
\ No newline at end of file
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized per-metric scaling of dstat data: z-score, robust (median/MAD)
+scaling and running statistics for live data.
+
+By default statistics are computed along axis 0, i.e. per metric (column)
+over time. Metrics with zero spread are only centered. Results keep dtype of
+float input (integers are scaled in float64), ``dtype=np.float32`` halves
+memory of float64 input at the cost of precision.
+"""
+
+import numpy as np
+
+# Scales MAD to standard deviation of normal distribution
+MAD_SCALE = 1.4826
+
+
+def _output(array, inplace, dtype):
+    """Returns float array to write result to, input itself if possible"""
+    array = np.asarray(array)
+    if inplace and array.dtype.kind == 'f' and array.flags.writeable:
+        return array
+    if dtype is None:
+        dtype = array.dtype if array.dtype.kind == 'f' else np.float64
+    return np.array(array, dtype=dtype)
+
+
+def _scale(out, center, spread, axis):
+    center = np.expand_dims(center, axis)
+    spread = np.expand_dims(spread, axis)
+    out -= center
+    # Constant metrics are left centered instead of dividing by zero
+    out /= np.where(spread > 0, spread, 1)
+    return out
+
+
+def zscore(array, axis=0, inplace=False, dtype=None):
+    """Subtracts mean and divides by standard deviation along ``axis``"""
+    out = _output(array, inplace, dtype)
+    return _scale(out, out.mean(axis=axis), out.std(axis=axis), axis)
+
+
+def robust_scale(array, axis=0, inplace=False, dtype=None):
+    """Subtracts median and divides by scaled median absolute deviation along ``axis``"""
+    out = _output(array, inplace, dtype)
+    median = np.median(out, axis=axis)
+    mad = np.median(np.abs(out - np.expand_dims(median, axis)), axis=axis) * MAD_SCALE
+    return _scale(out, median, mad, axis)
+
+
+class RunningStats(object):
+    __doc__ = """
+    Per-metric mean and variance updated batch by batch (Welford / Chan et
+    al. pairwise update), so live data can be scaled without keeping history
+    """
+    def __init__(self, size):
+        self.count = 0
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    def update(self, batch):
+        """Adds rows of 2D batch (or single row) to statistics"""
+        batch = np.atleast_2d(batch)
+        n = len(batch)
+        if not n:
+            return self
+        mean = batch.mean(axis=0)
+        m2 = ((batch - mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (float(n) / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (float(self.count) * n / total)
+        self.count = total
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count else np.zeros_like(self.m2)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def transform(self, batch, inplace=False, dtype=None):
+        """Z-scores rows of 2D batch with statistics accumulated so far"""
+        out = _output(batch, inplace, dtype)
+        return _scale(out, self.mean, self.std, 0)
@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+from dstat_anomaly_detection import MIN_THRESHOLD, Detector
+
+
+def workload(rows=500, seed=0):
+    """Returns baseline of 6 metrics driven by 2 latent factors, plus 2 constant ones"""
+    rnd = np.random.RandomState(seed)
+    latent = rnd.normal(size=(rows, 2))
+    mixing = rnd.normal(size=(2, 6))
+    data = np.dot(latent, mixing) + 0.01 * rnd.normal(size=(rows, 6))
+    return np.hstack([data, np.zeros((rows, 1)), np.full((rows, 1), 7.0)])
+
+
+class DetectorTest(unittest.TestCase):
+    def ratio(self, detector, data):
+        t2, spe = detector.score(data)
+        # as in dstat_pca.score_host()
+        return np.maximum(t2 / detector.t2_threshold, spe / detector.spe_threshold)
+
+    def test_constant_metrics_give_finite_scores(self):
+        baseline = workload()
+        detector = Detector().fit(baseline)
+        self.assertGreaterEqual(detector.spe_threshold, MIN_THRESHOLD)
+        self.assertTrue(np.isfinite(self.ratio(detector, baseline)).all())
+        # Metric which never moved in baseline is flagged once it does
+        changed = baseline[:10].copy()
+        changed[:, 6] = 1
+        self.assertTrue((self.ratio(detector, changed) > 1).all())
+
+    def test_all_components_kept(self):
+        baseline = workload()
+        detector = Detector(n_components=baseline.shape[1]).fit(baseline)
+        self.assertEqual(detector.spe_threshold, np.inf)
+        ratio = self.ratio(detector, baseline)
+        self.assertTrue(np.isfinite(ratio).all())
+        self.assertLess((ratio > 1).mean(), 0.02)
+
+    def test_all_metrics_constant(self):
+        detector = Detector().fit(np.ones((50, 3)))
+        self.assertTrue(np.isfinite(self.ratio(detector, np.ones((5, 3)))).all())
+
+    def test_detect_reports_interval_and_metric(self):
+        rows = workload(600)
+        detector = Detector(n_components=2).fit(rows[:500])
+        data = rows[500:]
+        # breaks correlation between metrics, invisible to T^2 alone
+        data[40:45, 3] += 5
+        intervals = detector.detect(data, ['m{0}'.format(idx) for idx in xrange(data.shape[1])])
+        self.assertIn((40, 45), [(interval.start, interval.end) for interval in intervals])
+        interval = next(interval for interval in intervals if interval.start == 40)
+        self.assertEqual(interval.metrics[0], 'm3')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from dstat_csv_parser import DstatData, align, field_names, follow_file, load_file, parse_body, parse_files, \
+    resample
+
+HEADER = '''"Dstat 0.7.2 CSV output"
+"Author:","Dag Wieers <dag@wieers.com>",,,,"URL:","http://dag.wieers.com/home-made/dstat/"
+"Host:","mmb00",,,,"User:","root"
+"Cmdline:","dstat -p -c --output mmb00.csv 10 180",,,,"Date:","18 Oct 2026 10:00:00 UTC"
+
+"procs",,,"total cpu usage",,,,,,"procs",,
+"run","blk","new","usr","sys","idl","wai","hiq","siq","run","blk","new"
+'''
+
+
+def rows(start, count):
+    return ''.join(','.join(str(float(start + row + column)) for column in xrange(12)) + '\n'
+                   for row in xrange(count))
+
+
+class DstatCsvParserTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'mmb00.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, text, mode='w'):
+        with open(self.filename, mode) as fd:
+            fd.write(text)
+
+    def test_field_names_dedupes_repeated_columns(self):
+        self.assertEqual(field_names(['procs/run', 'procs/run', 'cpu/usr']), ['procs/run', 'procs/run#2', 'cpu/usr'])
+
+    def test_parse_body_rejects_malformed_rows(self):
+        header, values, clocks = parse_body(['1,2', '3,4', ''], ['a', 'b'])
+        np.testing.assert_array_equal(values, [[1, 2], [3, 4]])
+        # Rows after empty or quoted field must not be dropped silently
+        for bad in (',6', '"5",6', '5'):
+            self.assertRaises(ValueError, parse_body, ['1,2', '3,4', bad, '7,8'], ['a', 'b'])
+
+    def test_load_file_skips_startup_row(self):
+        self.write(HEADER + rows(0, 4))
+        result = load_file(self.filename)
+        self.assertEqual(len(result.header), 12)
+        self.assertEqual(result.data.shape, (3, 12))
+        self.assertEqual(result.data[0, 0], 1.0)
+
+    def test_cache_is_invalidated_by_modification(self):
+        self.write(HEADER + rows(0, 4))
+        self.assertEqual(len(load_file(self.filename, cache=True).data), 3)
+        self.assertEqual(len(load_file(self.filename, cache=True).data), 3)
+        self.write(rows(10, 2), mode='a')
+        # mtime resolution may hide the append
+        os.utime(self.filename, (0, os.path.getmtime(self.filename) + 10))
+        self.assertEqual(len(load_file(self.filename, cache=True).data), 5)
+
+    def test_cache_is_written_atomically(self):
+        self.write(HEADER + rows(0, 4))
+        load_file(self.filename, cache=True)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['mmb00.csv', 'mmb00.csv.hdr', 'mmb00.csv.npy', 'mmb00.csv.times.npy'])
+
+    def test_cache_failure_is_not_fatal(self):
+        import logging
+        self.write(HEADER + rows(0, 4))
+        # Sidecar can't be written, like in read-only directory
+        os.mkdir(self.filename + '.npy')
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.assertEqual(len(load_file(self.filename, cache=True).data), 3)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['mmb00.csv', 'mmb00.csv.npy'])
+
+    def test_fleet_writes_no_sidecars_by_default(self):
+        import dstat_pca
+        names = list()
+        for idx in xrange(3):
+            names.append(os.path.join(self.directory, 'host{0}.csv'.format(idx)))
+            with open(names[-1], 'w') as fd:
+                fd.write(HEADER + rows(idx, 20))
+        self.assertEqual(len(dstat_pca.fleet(names, processes=1)), 3)
+        self.assertEqual(sorted(os.listdir(self.directory)), [os.path.basename(name) for name in names])
+
+    def test_parse_files_keeps_order(self):
+        names = list()
+        for idx in xrange(3):
+            name = os.path.join(self.directory, '{0}.csv'.format(idx))
+            with open(name, 'w') as fd:
+                fd.write(HEADER + rows(idx * 100, idx + 2))
+            names.append(name)
+        results = parse_files(names, processes=2)
+        self.assertEqual([len(result.data) for result in results], [1, 2, 3])
+
+    def test_follow_file_reads_rows_appended_after_eof(self):
+        self.write(HEADER + rows(0, 3))
+        _, header, batches = follow_file(self.filename, interval=0.01)
+        self.assertEqual(len(header), 12)
+        # Generator sleeps forever if appended rows are never seen
+        signal.signal(signal.SIGALRM, lambda *args: self.fail('appended rows are not read'))
+        signal.alarm(5)
+        try:
+            self.assertEqual(next(batches).shape, (2, 12))
+            # Rows arrive while follower is already polling at EOF
+            appender = threading.Timer(0.2, self.write, (rows(10, 5), 'a'))
+            appender.start()
+            batch = next(batches)
+            appender.join()
+        finally:
+            signal.alarm(0)
+        self.assertEqual(batch.shape, (5, 12))
+        np.testing.assert_array_equal(batch[:, 0], np.arange(10, 15))
+
+
+def host(header, times, data):
+    return DstatData([], header, np.empty((0, len(header))), np.asarray(data, dtype=np.float64),
+                     np.asarray(times, dtype=np.float64))
+
+
+class AlignTest(unittest.TestCase):
+    def setUp(self):
+        self.hosts = [host(['usr', 'sys'], [0, 10, 20], [[0, 1], [10, 2], [20, 3]]),
+                      host(['sys', 'new'], [5, 25], [[7, 1], [9, 3]])]
+
+    def test_align_takes_union_of_headers(self):
+        header, matrix = align(self.hosts)
+        self.assertEqual(header, ['host', 'usr', 'sys', 'new'])
+        np.testing.assert_array_equal(matrix, [[0, 0, 1, np.nan], [0, 10, 2, np.nan], [0, 20, 3, np.nan],
+                                               [1, np.nan, 7, 1], [1, np.nan, 9, 3]])
+
+    def test_resample_interpolates_onto_common_grid(self):
+        grid, header, cube = resample(self.hosts, step=5)
+        np.testing.assert_array_equal(grid, [0, 5, 10, 15, 20, 25])
+        self.assertEqual(header, ['usr', 'sys', 'new'])
+        self.assertEqual(cube.shape, (2, 6, 3))
+        np.testing.assert_allclose(cube[0, :, 1], [1, 1.5, 2, 2.5, 3, np.nan])
+        # NaN outside of host's time range and for metrics it doesn't have
+        np.testing.assert_allclose(cube[1, :, 1], [np.nan, 7, 7.5, 8, 8.5, 9])
+        self.assertTrue(np.isnan(cube[1, :, 0]).all())
+
+    def test_resample_sorts_samples_and_maps_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'cube.npy')
+        shuffled = host(['usr'], [20, 0, 10], [[2], [0], [1]])
+        grid, header, cube = resample([shuffled], filename=filename)
+        np.testing.assert_array_equal(grid, [0, 10, 20])
+        np.testing.assert_array_equal(np.load(filename)[0, :, 0], [0, 1, 2])
+
+    def test_resample_without_samples(self):
+        self.assertRaises(ValueError, resample, [host(['usr'], [], np.empty((0, 1)))])
+
+
+if __name__ == '__main__':
+    unittest.main()
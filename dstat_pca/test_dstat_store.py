@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dstat_store import DstatStore
+
+HEADER = ['usr', 'sys']
+DAY = 86400
+
+
+class DstatStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = DstatStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_read_range(self):
+        times = np.arange(0, 2 * DAY, 3600.0)
+        data = np.column_stack([times / 3600, -times / 3600])
+        self.store.append('host', HEADER, times[:30], data[:30])
+        self.store.append('host', HEADER, times[30:], data[30:])
+        self.assertEqual(self.store.hosts(), ['host'])
+        self.assertEqual(sorted(self.store.schema('host')['partitions']), ['0', str(DAY)])
+        result = self.store.read('host')
+        np.testing.assert_array_equal(result.times, times)
+        np.testing.assert_array_equal(result.data, data)
+        result = self.store.read('host', start=DAY - 3600, end=DAY + 3600)
+        np.testing.assert_array_equal(result.times, [DAY - 3600, DAY])
+
+    def test_metrics_appearing_later_are_nan_before(self):
+        self.store.append('host', ['usr'], [0, 1], [[1], [2]])
+        self.store.append('host', HEADER, [2], [[3, 4]])
+        result = self.store.read('host')
+        self.assertEqual(result.header, HEADER)
+        np.testing.assert_array_equal(result.data, [[1, np.nan], [2, np.nan], [3, 4]])
+
+    def test_converting_grown_file_again_adds_only_new_rows(self):
+        from dstat_store import convert
+        from test_dstat_csv_parser import HEADER as CSV_HEADER, rows
+        filename = os.path.join(self.directory, 'mmb00.csv')
+        with open(filename, 'w') as fd:
+            fd.write(CSV_HEADER + rows(0, 5))
+        convert(self.store, [filename])
+        convert(self.store, [filename])
+        self.assertEqual(len(self.store.read('mmb00').times), 4)
+        with open(filename, 'a') as fd:
+            fd.write(rows(5, 3))
+        convert(self.store, [filename])
+        result = self.store.read('mmb00')
+        self.assertEqual(len(result.times), 7)
+        self.assertEqual(len(np.unique(result.times)), 7)
+
+    def test_interrupted_append_is_discarded(self):
+        self.store.append('host', HEADER, [0, 1], [[1, 2], [3, 4]])
+        # Append killed after writing times and part of a column, schema isn't saved
+        partition = os.path.join(self.directory, 'host', '0')
+        with open(os.path.join(partition, 'time.f64'), 'ab') as fd:
+            fd.write(np.array([5, 6, 7], dtype=np.float64).tobytes())
+        with open(os.path.join(partition, '0.f32'), 'ab') as fd:
+            fd.write(np.array([9], dtype=np.float32).tobytes())
+        self.store.append('host', HEADER, [2], [[5, 6]])
+        result = self.store.read('host')
+        np.testing.assert_array_equal(result.times, [0, 1, 2])
+        np.testing.assert_array_equal(result.data, [[1, 2], [3, 4], [5, 6]])
+        self.assertEqual(os.path.getsize(os.path.join(partition, 'time.f64')), 3 * 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from pca import PCA, IncrementalPCA
+
+
+def low_rank(rows=400, columns=20, rank=3, seed=0):
+    """Returns rows driven by ``rank`` factors of decreasing scale plus a little noise"""
+    rnd = np.random.RandomState(seed)
+    latent = rnd.normal(size=(rows, rank)) * np.arange(rank, 0, -1) * 10
+    return np.dot(latent, rnd.normal(size=(rank, columns))) + rnd.normal(size=columns) + \
+        0.01 * rnd.normal(size=(rows, columns))
+
+
+def assert_same_components(a, b):
+    """Components match up to sign"""
+    np.testing.assert_allclose(np.abs((a * b).sum(axis=1)), 1, atol=1e-6)
+
+
+class PCATest(unittest.TestCase):
+    def test_methods_agree(self):
+        data = low_rank()
+        exact = PCA(n_components=3, method='exact').fit(data)
+        for method in ('covariance', 'randomized'):
+            model = PCA(n_components=3, method=method).fit(data)
+            np.testing.assert_allclose(model.explained_variance, exact.explained_variance, rtol=1e-6)
+            assert_same_components(model.components, exact.components)
+        self.assertGreater(exact.explained_variance_ratio.sum(), 0.999)
+        np.testing.assert_allclose(exact.explained_variance, np.var(exact.transform(data), axis=0, ddof=1))
+
+    def test_auto_method(self):
+        model = PCA(n_components=2)
+        self.assertEqual(model._method(10000, 20), 'covariance')
+        self.assertEqual(model._method(3000, 3000), 'randomized')
+        self.assertEqual(model._method(100, 50), 'exact')
+
+    def test_reconstruction(self):
+        data = low_rank()
+        model = PCA(n_components=3).fit(data)
+        np.testing.assert_allclose(model.inverse_transform(model.transform(data)), data, atol=0.1)
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        data = low_rank()
+        model = PCA(n_components=2).fit(data)
+        path = os.path.join(directory, 'model.npz')
+        model.save(path)
+        loaded = PCA.load(path)
+        np.testing.assert_array_equal(loaded.transform(data), model.transform(data))
+        np.testing.assert_array_equal(loaded.explained_variance_ratio, model.explained_variance_ratio)
+        self.assertEqual(loaded.n_samples, len(data))
+
+
+class IncrementalPCATest(unittest.TestCase):
+    def test_batches_match_pca(self):
+        data = low_rank()
+        model = IncrementalPCA(n_components=3)
+        for batch in np.array_split(data, 13):
+            model.partial_fit(batch)
+        exact = PCA(n_components=3, method='exact').fit(data)
+        self.assertEqual(model.n_samples, len(data))
+        np.testing.assert_allclose(model.mean, exact.mean)
+        np.testing.assert_allclose(model.explained_variance, exact.explained_variance, rtol=1e-6)
+        np.testing.assert_allclose(model.explained_variance_ratio, exact.explained_variance_ratio, rtol=1e-6)
+        assert_same_components(model.components, exact.components)
+
+    def test_projection_does_not_flip(self):
+        data = low_rank()
+        model = IncrementalPCA(n_components=3).partial_fit(data[:100])
+        previous = model.components
+        for batch in np.array_split(data[100:], 10):
+            components = model.partial_fit(batch).components
+            self.assertTrue(((components * previous).sum(axis=1) > 0).all())
+            previous = components
+
+    def test_forgetting_follows_workload(self):
+        data = low_rank()
+        model = IncrementalPCA(n_components=2, forgetting=0.9)
+        model.partial_fit(data)
+        model.partial_fit(data[:100] + 1000)
+        np.testing.assert_allclose(model.mean, data[:100].mean(axis=0) + 1000, rtol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
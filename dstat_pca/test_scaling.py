@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+
+from scaling import RunningStats, robust_scale, zscore
+
+
+class ScalingTest(unittest.TestCase):
+    def setUp(self):
+        rnd = np.random.RandomState(0)
+        self.data = np.column_stack([rnd.normal(1e6, 1e-3, size=100), rnd.normal(size=100), np.full(100, 5.0)])
+
+    def test_dtype_of_input_is_kept(self):
+        for scale in (zscore, robust_scale, RunningStats(3).update(self.data).transform):
+            self.assertEqual(scale(self.data).dtype, np.float64)
+            self.assertEqual(scale(self.data.astype(np.float32)).dtype, np.float32)
+            self.assertEqual(scale(self.data, dtype=np.float32).dtype, np.float32)
+            self.assertEqual(scale(self.data.astype(np.int64)).dtype, np.float64)
+
+    def test_zscore(self):
+        out = zscore(self.data)
+        # float32 of 1e6 has no digits left for 1e-3 deviations
+        np.testing.assert_allclose(out[:, :2].mean(axis=0), 0, atol=1e-6)
+        np.testing.assert_allclose(out[:, :2].std(axis=0), 1)
+        # Constant metric is only centered
+        np.testing.assert_array_equal(out[:, 2], 0)
+
+    def test_inplace(self):
+        data = self.data.copy()
+        self.assertIs(zscore(data, inplace=True), data)
+        np.testing.assert_allclose(data, zscore(self.data))
+
+    def test_robust_scale_ignores_outliers(self):
+        data = self.data[:, 1].copy()
+        data[:5] = 1e9
+        out = robust_scale(data)
+        self.assertLess(abs(np.median(out)), 1e-9)
+        self.assertLess(np.abs(out[5:]).max(), 10)
+
+    def test_running_stats_match_batch(self):
+        stats = RunningStats(3)
+        for batch in np.array_split(self.data, 7):
+            stats.update(batch)
+        self.assertEqual(stats.count, 100)
+        np.testing.assert_allclose(stats.mean, self.data.mean(axis=0))
+        np.testing.assert_allclose(stats.std, self.data.std(axis=0), atol=1e-12)
+        np.testing.assert_allclose(stats.transform(self.data), zscore(self.data), atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
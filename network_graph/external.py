@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+External memory aggregation. Values of equal keys are combined in a dict
+until it outgrows memory budget, then it is sorted and spilled as a run
+file to local disk. Runs are k-way merged back in key order, so input size
+is limited by disk rather than RAM.
+
+Keys and values must be marshallable (numbers, strings, tuples, lists).
+"""
+
+import marshal
+import os
+import sys
+import tempfile
+
+from heapq import merge
+from itertools import groupby, islice
+from operator import add, itemgetter
+
+# Budget of every aggregator when --max-memory is not given
+DEFAULT_BUDGET = 256 << 20
+# Share of --max-memory every aggregator may use
+BUDGET_SHARE = 4
+# Approximate size of dict slot, on top of key and value
+ENTRY_OVERHEAD = 100
+# Records are written and read in blocks of that many
+BLOCK_SIZE = 4096
+# Runs are merged into one when there are that many, bounds open files
+MAX_RUNS = 64
+
+
+def memory_budget():
+    """Budget in bytes derived from --max-memory"""
+    from runtime import RUNTIME
+    return RUNTIME.max_memory // BUDGET_SHARE or DEFAULT_BUDGET
+
+
+def sizeof(value):
+    """Approximate size of value, with items of tuple or list"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+def add_vectors(a, b):
+    """Elementwise sum of equal length tuples"""
+    return tuple(x + y for x, y in zip(a, b))
+
+
+def read_run(path):
+    """Yields (key, value) items of run file"""
+    with open(path, 'rb') as run:
+        while True:
+            try:
+                block = marshal.load(run)
+            except EOFError:
+                return
+            for item in block:
+                yield item
+
+
+class ExternalAggregator(object):
+    __doc__ = """
+    Combines values of equal keys with ``combine`` in about ``budget``
+    bytes (estimated from the first entry), sorted runs are spilled to
+    temporary files in ``directory`` (``$TMPDIR`` by default)
+    """
+    def __init__(self, combine=add, budget=None, directory=None):
+        self.combine = combine
+        self.budget = budget or memory_budget()
+        self.directory = directory
+        self.capacity = None
+        self.table = dict()
+        self.runs = list()
+        self.spills = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, key, value):
+        table = self.table
+        if key in table:
+            table[key] = self.combine(table[key], value)
+            return
+        if self.capacity is None:
+            self.capacity = max(self.budget // (sizeof(key) + sizeof(value) + ENTRY_OVERHEAD), 1)
+        elif len(table) >= self.capacity:
+            self.spill()
+        self.table[key] = value
+
+    def update(self, items):
+        for key, value in items:
+            self.add(key, value)
+
+    def _combined(self, items):
+        for key, group in groupby(items, key=itemgetter(0)):
+            yield key, reduce(self.combine, (value for _, value in group))
+
+    def _write(self, items):
+        fd, path = tempfile.mkstemp(prefix='spill-', suffix='.run', dir=self.directory)
+        with os.fdopen(fd, 'wb') as run:
+            while True:
+                block = list(islice(items, BLOCK_SIZE))
+                if not block:
+                    break
+                marshal.dump(block, run)
+        return path
+
+    def spill(self):
+        """Writes table sorted by key to a new run and empties it"""
+        if not self.table:
+            return
+        items, self.table = sorted(self.table.iteritems()), dict()
+        self.runs.append(self._write(iter(items)))
+        self.spills += 1
+        if len(self.runs) >= MAX_RUNS:
+            runs = self.runs
+            self.runs = [self._write(self._combined(merge(*map(read_run, runs))))]
+            self._remove(runs)
+
+    def items(self):
+        """Yields (key, combined value) in key order, aggregator is emptied"""
+        items, self.table = sorted(self.table.iteritems()), dict()
+        try:
+            for item in self._combined(merge(items, *map(read_run, self.runs))):
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Removes run files"""
+        self._remove(self.runs)
+        self.runs = list()
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
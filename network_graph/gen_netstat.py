@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic ``netstat -an`` corpus generator and ingest benchmark for
+``parse_netstat.py``.
+"""
+
+import os
+import sys
+import time
+
+# Ports of services hosts talk to
+SERVICES = [22, 80, 443, 3306, 5432, 6379, 8080, 9000]
+STATES = ['ESTABLISHED'] * 8 + ['TIME_WAIT', 'CLOSE_WAIT']
+
+LINUX_HEADER = """Active Internet connections (servers and established)
+Proto Recv-Q Send-Q Local Address           Foreign Address         State
+"""
+FREEBSD_HEADER = """Active Internet connections (including servers)
+Proto Recv-Q Send-Q Local Address          Foreign Address        (state)
+"""
+
+
+def address(idx, ipv6=False):
+    """Returns address of host number ``idx``, outside of filtered 10/8"""
+    if ipv6:
+        return '2001:db8::{0:x}:{1:x}'.format(idx >> 16, idx & 0xffff)
+    return '172.{0}.{1}.{2}'.format(16 + (idx >> 16) % 16, (idx >> 8) & 255, idx & 255)
+
+
+def netstat_lines(host, popularity, fanout, ipv6_share, freebsd, rnd):
+    """Yields lines of one ``netstat -an`` snapshot of a host, ``popularity`` is list of all hosts, most popular first"""
+    separator = '.' if freebsd else ':'
+    yield FREEBSD_HEADER if freebsd else LINUX_HEADER
+    for port in rnd.sample(SERVICES, 3):
+        if freebsd:
+            yield 'tcp4       0      0 *.{0:<20} *.*                    LISTEN\n'.format(port)
+        else:
+            yield 'tcp        0      0 0.0.0.0:{0:<15} 0.0.0.0:*               LISTEN\n'.format(port)
+    for _ in xrange(max(1, int(rnd.expovariate(1.0 / fanout)))):
+        ipv6 = rnd.random() < ipv6_share
+        # Popular hosts get most of connections, whoever connects to them
+        peer = host
+        while peer == host and len(popularity) > 1:
+            peer = popularity[(int(rnd.paretovariate(1.2)) - 1) % len(popularity)]
+        service, ephemeral = rnd.choice(SERVICES), rnd.randint(32768, 61000)
+        local, foreign = (ephemeral, service) if rnd.random() < 0.5 else (service, ephemeral)
+        recv_q, send_q = (rnd.randint(1, 65536), 0) if rnd.random() < 0.05 else (0, 0)
+        if freebsd:
+            proto = 'tcp6' if ipv6 else 'tcp4'
+        else:
+            proto = 'tcp6' if ipv6 else 'tcp'
+        yield '{0:<5} {1:>6} {2:>6} {3:<23} {4:<23} {5}\n'.format(
+            proto, recv_q, send_q,
+            address(host, ipv6) + separator + str(local),
+            address(peer, ipv6) + separator + str(foreign),
+            rnd.choice(STATES))
+
+
+def open_output(filename, compression):
+    """Opens file for writing with compression"""
+    if compression == 'gzip':
+        from gzip import GzipFile
+        return GzipFile(filename + '.gz', 'wb')
+    if compression == 'bz2':
+        from bz2 import BZ2File
+        return BZ2File(filename + '.bz2', 'wb')
+    if compression == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma
+        return lzma.LZMAFile(filename + '.xz', 'wb')
+    return open(filename, 'wb')
+
+
+def generate_corpus(directory, hosts, fanout=50, ipv6=0.1, freebsd=0.1, compression='', snapshots=1, seed=0):
+    """Writes one file per host to directory, returns list of filenames"""
+    import random
+    rnd = random.Random(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    started = int(time.time()) - snapshots * 60
+    popularity = range(hosts)
+    rnd.shuffle(popularity)
+    filenames = list()
+    for host in xrange(hosts):
+        filename = os.path.join(directory, 'host{0:06d}.netstat'.format(host))
+        is_freebsd = rnd.random() < freebsd
+        out = open_output(filename, compression)
+        try:
+            for snapshot in xrange(snapshots):
+                if snapshots > 1:
+                    out.write('{0}\n'.format(started + snapshot * 60))
+                out.write(''.join(netstat_lines(host, popularity, fanout, ipv6, is_freebsd, rnd)))
+        finally:
+            out.close()
+        filenames.append(out.name)
+    return filenames
+
+
+from opster import command, dispatch
+
+@command(usage='[OPTIONS] [DIRECTORY]')
+def generate(directory='stats',
+             hosts=('n', 1000, 'number of hosts (files)'),
+             fanout=('f', 50, 'mean number of connections per host'),
+             ipv6=('6', 0.1, 'share of IPv6 connections'),
+             freebsd=('b', 0.1, 'share of hosts with FreeBSD netstat format'),
+             compression=('z', '', 'compress files with gzip, bz2 or xz'),
+             snapshots=('s', 1, 'number of snapshots per file, each prefixed by date +%s'),
+             seed=('', 0, 'random seed')):
+    """Generate synthetic netstat -an dumps"""
+    filenames = generate_corpus(directory, hosts, fanout, ipv6, freebsd, compression, snapshots, seed)
+    print "Generated {0} files in {1}".format(len(filenames), directory)
+
+
+@command(hide=True)
+def ingest(directory, database, resolve=('r', False, 'resolve node names via reverse DNS')):
+    """Ingest all files of directory and print time and peak memory as JSON"""
+    import json
+    import resource
+    import parse_netstat
+    filenames = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+    options = ['-o', database, '-c', os.devnull] + ([] if resolve else ['--no-resolve'])
+    started = time.time()
+    parse_netstat.main.command(options + filenames)
+    elapsed = time.time() - started
+    # ru_maxrss is in kilobytes on Linux
+    print json.dumps(dict(files=len(filenames), seconds=elapsed,
+                          parent_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                          worker_rss_mb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0))
+
+
+@command()
+def bench(sizes=('s', '1000,10000,100000', 'comma separated corpus sizes'),
+          fanout=('f', 50, 'mean number of connections per host'),
+          ipv6=('6', 0.1, 'share of IPv6 connections'),
+          compression=('z', '', 'compress files with gzip, bz2 or xz'),
+          resolve=('r', False, 'resolve node names via reverse DNS, synthetic addresses usually time out'),
+          keep=('k', False, 'keep generated corpora and databases')):
+    """Measure end-to-end ingest time and peak memory of parse_netstat.py"""
+    import json
+    import logging
+    import shutil
+    import subprocess
+    import tempfile
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='netstat_bench_')
+    try:
+        print "{0:>8} {1:>10} {2:>10} {3:>14} {4:>14}".format('files', 'seconds', 'files/s', 'parent RSS, MB', 'worker RSS, MB')
+        for size in [int(size) for size in sizes.split(',')]:
+            directory = os.path.join(workdir, str(size))
+            generate_corpus(directory, size, fanout=fanout, ipv6=ipv6, compression=compression)
+            # Fresh process per size, so peak memory is not inherited
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'ingest', directory,
+                                              os.path.join(workdir, '{0}.db'.format(size))] + (['-r'] if resolve else []))
+            result = json.loads(output.strip().splitlines()[-1])
+            print "{0:>8} {1:>10.2f} {2:>10.1f} {3:>14.1f} {4:>14.1f}".format(
+                result['files'], result['seconds'], result['files'] / result['seconds'],
+                result['parent_rss_mb'], result['worker_rss_mb'])
+            sys.stdout.flush()
+    finally:
+        if keep:
+            print "Corpora and databases are kept in {0}".format(workdir)
+        else:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    dispatch()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Analytics over ``nodes``/``edges`` tables produced by ``parse_netstat.py``.
+
+Graph is loaded into CSR adjacency (``indptr``, ``indices``, ``weights``
+NumPy arrays) with nodes numbered in order of the ``nodes`` table, all
+kernels below are vectorized over it.
+"""
+
+import logging
+
+from opster import command, lazy_import
+
+# NumPy is imported on first use, so --help and completion don't wait for it
+np = lazy_import('numpy')
+
+# Number of rows fetched from database at once
+FETCH_BATCH = 100000
+
+
+class Graph(object):
+    __doc__ = """Directed weighted graph in CSR form"""
+    def __init__(self, ids, labels, dcs, sources, targets, weights):
+        self.ids = ids
+        self.labels = labels
+        self.dcs = dcs
+        n = len(ids)
+        order = np.argsort(sources, kind='mergesort')
+        self.indices = targets[order]
+        self.weights = weights[order]
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n), out=self.indptr[1:])
+
+    @property
+    def size(self):
+        return len(self.ids)
+
+    def sources(self):
+        """Source node of every edge in CSR order"""
+        return np.repeat(np.arange(self.size), np.diff(self.indptr))
+
+
+def fetch_columns(cursor, dtypes):
+    """Reads cursor into one NumPy array per column, batch by batch"""
+    columns = [list() for _ in dtypes]
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH)
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+    return [np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes)]
+
+
+def load_graph(filename):
+    """Loads graph from sqlite database created by ``parse_netstat.py``"""
+    from sqlite3 import connect
+    conn = connect(filename)
+    ids, labels, dcs = fetch_columns(conn.execute('''select id, label, dc from nodes'''), [object, object, object])
+    index = dict((id_, idx) for idx, id_ in enumerate(ids))
+    sources, targets, weights = list(), list(), list()
+    cursor = conn.execute('''select source, target, weight from edges''')
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH)
+        if not rows:
+            break
+        batch_sources, batch_targets, batch_weights = zip(*rows)
+        # Edges may reference nodes which failed to be inserted
+        for node in set(batch_sources).union(batch_targets).difference(index):
+            index[node] = len(index)
+        sources.append(np.array(map(index.__getitem__, batch_sources), dtype=np.int64))
+        targets.append(np.array(map(index.__getitem__, batch_targets), dtype=np.int64))
+        weights.append(np.array(batch_weights, dtype=np.float64))
+    conn.close()
+    if len(index) > len(ids):
+        extra = np.array(sorted(index, key=index.get)[len(ids):], dtype=object)
+        ids, labels = np.concatenate([ids, extra]), np.concatenate([labels, extra])
+        dcs = np.concatenate([dcs, np.array([''] * len(extra), dtype=object)])
+    concat = lambda arrays, dtype: np.concatenate(arrays) if arrays else np.array([], dtype=dtype)
+    return Graph(ids, labels, dcs, concat(sources, np.int64), concat(targets, np.int64), concat(weights, np.float64))
+
+
+def degrees(graph, weighted=False):
+    """Returns (out, in) degree of every node"""
+    weights = graph.weights if weighted else None
+    out_degree = np.bincount(graph.sources(), weights=weights, minlength=graph.size)
+    in_degree = np.bincount(graph.indices, weights=weights, minlength=graph.size)
+    return out_degree, in_degree
+
+
+def degree_distribution(degree):
+    """Returns (degree, number of nodes with that degree) arrays"""
+    counts = np.bincount(degree.astype(np.int64))
+    values = np.nonzero(counts)[0]
+    return values, counts[values]
+
+
+def top_talkers(graph, k=10):
+    """Returns indexes of ``k`` nodes with most connections (in and out)"""
+    out_weight, in_weight = degrees(graph, weighted=True)
+    total = out_weight + in_weight
+    k = min(k, graph.size)
+    top = np.argpartition(-total, k - 1)[:k] if k else np.array([], dtype=np.int64)
+    return top[np.argsort(-total[top])], total
+
+
+def connected_components(graph):
+    """
+    Labels weakly connected components by min-label propagation with pointer
+    jumping. Returns array of component labels.
+    """
+    sources, targets = graph.sources(), graph.indices
+    labels = np.arange(graph.size)
+    while True:
+        edge_labels = np.minimum(labels[sources], labels[targets])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, sources, edge_labels)
+        np.minimum.at(new_labels, targets, edge_labels)
+        # Pointer jumping makes long chains converge in log steps
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def pagerank(graph, damping=0.85, tol=1e-9, max_iter=100):
+    """Weighted PageRank by power iteration, dangling nodes spread uniformly"""
+    n = graph.size
+    if not n:
+        return np.array([])
+    sources = graph.sources()
+    out_weight = np.bincount(sources, weights=graph.weights, minlength=n)
+    dangling = out_weight == 0
+    share = graph.weights / np.where(dangling, 1, out_weight)[sources]
+    rank = np.full(n, 1.0 / n)
+    for _ in xrange(max_iter):
+        spread = np.bincount(graph.indices, weights=rank[sources] * share, minlength=n)
+        new_rank = (1 - damping) / n + damping * (spread + rank[dangling].sum() / n)
+        converged = np.abs(new_rank - rank).sum() < tol
+        rank = new_rank
+        if converged:
+            break
+    return rank
+
+
+def dc_matrix(graph):
+    """Returns (dc names, matrix of traffic from DC to DC)"""
+    names, dc_idx = np.unique(graph.dcs.astype(str), return_inverse=True)
+    m = len(names)
+    pairs = dc_idx[graph.sources()] * m + dc_idx[graph.indices]
+    return names, np.bincount(pairs, weights=graph.weights, minlength=m * m).reshape(m, m)
+
+
+def report(graph, top=10):
+    """Prints summary of the graph"""
+    out_degree, in_degree = degrees(graph)
+    components = connected_components(graph)
+    component_sizes = np.bincount(components)
+    print "nodes: {0}, edges: {1}, components: {2}, largest: {3}".format(
+        graph.size, len(graph.indices), np.count_nonzero(component_sizes), component_sizes.max() if graph.size else 0)
+
+    print "\nout degree distribution (degree: nodes):"
+    for degree, count in zip(*degree_distribution(out_degree)):
+        print "  {0}: {1}".format(degree, count)
+
+    print "\ntop talkers:"
+    talkers, total = top_talkers(graph, top)
+    for idx in talkers:
+        print "  {0} ({1}): {2:g}".format(graph.labels[idx], graph.ids[idx], total[idx])
+
+    print "\ntop by pagerank:"
+    rank = pagerank(graph)
+    for idx in np.argsort(-rank)[:top]:
+        print "  {0} ({1}): {2:.6f}".format(graph.labels[idx], graph.ids[idx], rank[idx])
+
+    names, matrix = dc_matrix(graph)
+    print "\ncross-DC traffic (rows are sources):"
+    width = max([len(name) for name in names] + [8])
+    print " " * width, " ".join("{0:>{1}}".format(name or '-', width) for name in names)
+    for name, row in zip(names, matrix):
+        print "{0:>{1}}".format(name or '-', width), " ".join("{0:>{1}g}".format(value, width) for value in row)
+
+
+@command()
+def main(filename='output/graph.db',
+         top=('t', 10, 'number of top nodes to show'),
+         verbose=('v', False, 'be verbose')):
+    """Show statistics of graph database created by parse_netstat.py"""
+
+    severity=logging.WARNING
+    if verbose:
+        severity=logging.DEBUG
+    logging.basicConfig(level=severity)
+
+    report(load_graph(filename), top=top)
+
+if __name__ == '__main__':
+    main.command()
@@ -2,32 +2,42 @@
 '''Command line arguments parser
 '''
 
-import sys, traceback, getopt, types, textwrap, inspect, os, copy, keyword
+import sys, getopt, types, os, keyword, time
 from itertools import imap
 from functools import wraps
 
+# Heavier modules (inspect, traceback, textwrap, copy, locale) are imported
+# only when needed, so --help and completion start as fast as possible
 
-__all__ = ['Dispatcher', 'command', 'dispatch']
+__all__ = ['Dispatcher', 'command', 'dispatch', 'LazyCommand', 'lazy_import']
 __version__ = '3.3.1'
 __author__ = 'Alexander Solovyov'
 __email__ = 'alexander@solovyov.net'
 
 
-try:
-    import locale
-    ENCODING = locale.getpreferredencoding()
-    if (not ENCODING or ENCODING == 'mac-roman' or 'ascii' in ENCODING.lower()
-        or 'ansi' in ENCODING.lower()):
-        ENCODING = 'UTF-8'
-except locale.Error:
-    ENCODING = 'UTF-8'
+ENCODING = None
+
+
+def encoding():
+    '''Preferred encoding of output, determined on first use'''
+    global ENCODING
+    if ENCODING is None:
+        import locale
+        try:
+            ENCODING = locale.getpreferredencoding()
+            if (not ENCODING or ENCODING == 'mac-roman' or
+                'ascii' in ENCODING.lower() or 'ansi' in ENCODING.lower()):
+                ENCODING = 'UTF-8'
+        except locale.Error:
+            ENCODING = 'UTF-8'
+    return ENCODING
 
 
 def write(text, out=None):
     '''Write output to a given stream (stdout by default)'''
     out = out or sys.stdout
     if sys.version_info < (3, 0) and isinstance(text, unicode):
-        text = text.encode(ENCODING)
+        text = text.encode(encoding())
     out.write(text)
 
 
@@ -146,6 +156,8 @@ class Dispatcher(object):
 
                 if argv is None:
                     argv = sys.argv[1:]
+                argv = startup_profile(argv)
+                startup_report()
                 try:
                     args, opts = process(argv, options_)
                 except Exception, e:
@@ -157,7 +169,9 @@ class Dispatcher(object):
                     return func.help()
 
                 try:
-                    return call_cmd(scriptname, func, options_)(*args, **opts)
+                    # global options are handled by middleware, as in dispatch()
+                    return call_cmd(scriptname, func, options_,
+                                    self.middleware)(*args, **opts)
                 except Exception, e:
                     if exchandle(e, func.help):
                         return -1
@@ -200,7 +214,7 @@ class Dispatcher(object):
 
         - ``args``: list of arguments, default: ``sys.argv[1:]``
         '''
-        args = args or sys.argv[1:]
+        args = startup_profile(args or sys.argv[1:])
 
         help_func = self.cmdtable['help'][0]
         autocomplete(self.cmdtable, args, self.middleware)
@@ -212,6 +226,8 @@ class Dispatcher(object):
                 return -1
             raise
 
+        # includes import of lazy command just resolved
+        startup_report()
         try:
             mw = name != '_completion' and self.middleware or None
             return call_cmd(name, func, options, mw)(*args, **kwargs)
@@ -275,7 +291,9 @@ def help_(cmdtable, globalopts):
                 if shortlist and not cmd.startswith('^'):
                     continue  # short help contains only marked commands
                 cmd = cmd.lstrip('^~')
-                doc = pretty_doc_string(info[0])
+                # lazy commands know their doc without being imported
+                doc = pretty_doc_string(
+                    info if isinstance(info, LazyCommand) else info[0])
                 hlp[cmd] = doc.strip().splitlines()[0].rstrip()
 
             hlplist = sorted(hlp)
@@ -358,6 +376,7 @@ def help_options(options):
                                   name and ' --%s' % name),
                        '%s%s' % (desc, default)))
 
+    import textwrap
     opts_len = max([len(first) for first, second in output if second] or [0])
     for first, second in output:
         if second:
@@ -405,8 +424,10 @@ def process(args, options, preparse=False):
         defmap[pyname] = default
 
         # copy defaults to state
-        if isinstance(default, (list, dict)):
-            state[pyname] = copy.copy(default)
+        if isinstance(default, list):
+            state[pyname] = list(default)
+        elif isinstance(default, dict):
+            state[pyname] = dict(default)
         elif isinstance(default, types.FunctionType):
             funlist.append(pyname)
             state[pyname] = None
@@ -517,7 +538,10 @@ def findpossible(cmd, table):
                     found = a
                     break
         if found is not None:
-            choice[found] = (aliases, table[e])
+            entry = table[e]
+            if isinstance(entry, LazyCommand):
+                entry = entry.resolve()
+            choice[found] = (aliases, entry)
 
     return choice
 
@@ -544,6 +568,38 @@ def findcmd(cmd, table):
 # Helpers
 # --------
 
+class ArgSpec(tuple):
+    '''Same as ``inspect.ArgSpec``'''
+    args = property(lambda self: self[0])
+    varargs = property(lambda self: self[1])
+    keywords = property(lambda self: self[2])
+    defaults = property(lambda self: self[3])
+
+
+def getargspec(func):
+    '''Light version of ``inspect.getargspec`` for plain functions and methods
+
+    Importing ``inspect`` takes longer than everything else opster does on
+    startup.
+
+    >>> def test(a, b=1, *args, **kwargs):
+    ...     pass
+    >>> getargspec(test)
+    (['a', 'b'], 'args', 'kwargs', (1,))
+    '''
+    func = getattr(func, 'im_func', func)
+    code = func.func_code
+    args = list(code.co_varnames[:code.co_argcount])
+    idx = code.co_argcount
+    varargs = keywords = None
+    if code.co_flags & 0x04:  # CO_VARARGS
+        varargs = code.co_varnames[idx]
+        idx += 1
+    if code.co_flags & 0x08:  # CO_VARKEYWORDS
+        keywords = code.co_varnames[idx]
+    return ArgSpec((args, varargs, keywords, func.func_defaults))
+
+
 def guess_options(func):
     '''Get options definitions from function
 
@@ -554,7 +610,7 @@ def guess_options(func):
 
     See docstring of ``command()`` for description of those variables.
     '''
-    args, _, _, defaults = inspect.getargspec(func)
+    args, _, _, defaults = getargspec(func)
     for name, option in zip(args[-len(defaults):], defaults):
         if not isinstance(option, tuple):
             continue
@@ -569,7 +625,7 @@ def guess_usage(func, options):
     usage = ['%name']
     if options:
         usage.append('[OPTIONS]')
-    arginfo = inspect.getargspec(func)
+    arginfo = getargspec(func)
     optnames = [x[1] for x in options]
     nonoptional = len(arginfo.args) - len(arginfo.defaults or ())
 
@@ -611,7 +667,7 @@ def call_cmd(name, func, opts, middleware=None):
     '''Wrapper for command call, catching situation with insufficient arguments
     '''
     # depth is necessary when there is a middleware in setup
-    arginfo = inspect.getargspec(func)
+    arginfo = getargspec(func)
     if middleware:
         tocall = middleware(func)
         depth = 2
@@ -640,6 +696,7 @@ def call_cmd(name, func, opts, middleware=None):
         try:
             return tocall(*args, **kwargs)
         except TypeError:
+            import traceback
             if len(traceback.extract_tb(sys.exc_info()[2])) == depth:
                 raise ParseError(name, "invalid arguments")
             raise
@@ -650,7 +707,7 @@ def call_cmd_regular(func, opts):
     '''Wrapper for command for handling function calls from Python
     '''
     def inner(*args, **kwargs):
-        arginfo = inspect.getargspec(func)
+        arginfo = getargspec(func)
         if len(args) > len(arginfo.args):
             raise TypeError('You have supplied more positional arguments'
                             ' than applicable')
@@ -705,10 +762,265 @@ def name_to_python(name):
     return name
 
 
+# --------
+# Lazy loading
+# --------
+
+class LazyCommand(object):
+    '''Command table entry importing ``'module:function'`` on first use
+
+    Function should be decorated with ``command()``. ``doc`` is shown in
+    the list of commands, so listing them doesn't import anything::
+
+      dispatch(cmdtable={
+          'ingest': LazyCommand('parse_netstat:main', 'Ingest netstat files'),
+      })
+    '''
+
+    def __init__(self, target, doc=None):
+        self.target = target
+        self.doc = doc
+        self._entry = None
+
+    @property
+    def __doc__(self):
+        if self.doc is not None:
+            return self.doc
+        return self.resolve()[0].__doc__
+
+    def resolve(self):
+        '''Returns usual (function, options, usage) command table entry'''
+        if self._entry is None:
+            module, name = self.target.split(':', 1)
+            func = getattr(__import__(module, fromlist=[name]), name)
+            self._entry = (getattr(func, 'orig', func),
+                           getattr(func, 'opts', []),
+                           getattr(func, 'usage', '%name'))
+        return self._entry
+
+
+class LazyModule(types.ModuleType):
+    '''Module proxy importing the real module on first attribute access'''
+
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = __import__(self.__name__, fromlist=['__name__'])
+            self.__dict__['_module'] = module
+        value = getattr(module, attr)
+        # next lookups of attribute don't go through the proxy
+        self.__dict__[attr] = value
+        return value
+
+
+def lazy_import(name):
+    '''Returns module ``name`` which is imported only when used
+
+    >>> json = lazy_import('json')
+    >>> json.dumps([1])
+    '[1]'
+    '''
+    return LazyModule(name)
+
+
+# --------
+# Startup profile
+# --------
+
+class ImportProfiler(object):
+    '''``__import__`` hook accumulating time spent importing every module'''
+
+    def __init__(self):
+        import __builtin__
+        self.builtins = __builtin__
+        self.original = __builtin__.__import__
+        self.times = {}
+        self.stack = []
+
+    def install(self):
+        self.builtins.__import__ = self
+
+    def uninstall(self):
+        self.builtins.__import__ = self.original
+
+    def __call__(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self.original(name, *args, **kwargs)
+        key = name
+        if not name and args and args[0]:
+            # ``from . import x`` is accounted to the importing package
+            key = 'from %s' % (args[0].get('__package__') or
+                               args[0].get('__name__'))
+        self.stack.append(0.0)
+        started = time.time()
+        try:
+            return self.original(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - started
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            total, own = self.times.get(key, (0.0, 0.0))
+            self.times[key] = total + elapsed, own + elapsed - nested
+
+
+def process_age():
+    '''Seconds since process start, None where /proc is not available'''
+    try:
+        with open('/proc/self/stat') as stat:
+            # skip command name, it may contain spaces
+            started = int(stat.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as uptime:
+            now = float(uptime.read().split()[0])
+        return now - float(started) / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+_import_profiler = None
+
+
+def startup_profile(args):
+    '''Returns ``args`` without ``--startup-profile``, timing imports if it was there
+
+    >>> startup_profile(['-v', 'file'])
+    ['-v', 'file']
+    '''
+    global _import_profiler, _profile_started, _profile_started_age
+    if '--startup-profile' not in args:
+        return args
+    if _import_profiler is None:
+        _import_profiler = ImportProfiler()
+        _import_profiler.install()
+        _profile_started = time.time()
+        _profile_started_age = process_age()
+    return [arg for arg in args if arg != '--startup-profile']
+
+
+def startup_report(out=None, top=15):
+    '''Writes report of startup cost to stderr if ``--startup-profile`` was given'''
+    global _import_profiler
+    profiler, _import_profiler = _import_profiler, None
+    if profiler is None:
+        return
+    profiler.uninstall()
+    out = out or sys.stderr
+    since_start = time.time() - _profile_started
+    if _profile_started_age is not None:
+        write('startup: %.1f ms, %.1f ms before command line was parsed\n' % (
+            (_profile_started_age + since_start) * 1000,
+            _profile_started_age * 1000), out)
+    write('%.1f ms from parsing command line to command start, slowest '
+          'imports:\n' % (since_start * 1000), out)
+    write(' %10s %10s  %s\n' % ('total, ms', 'self, ms', 'module'), out)
+    ranked = sorted(profiler.times.items(), key=lambda item: -item[1][1])
+    for name, (total, own) in ranked[:top]:
+        write(' %10.1f %10.1f  %s\n' % (total * 1000, own * 1000, name), out)
+
+
 # --------
 # Autocomplete system
 # --------
 
+# Seconds completer results are reused for, e.g. listings of big directories
+COMPLETION_TTL = float(os.environ.get('OPSTER_COMPLETION_TTL', 30))
+
+
+class CompletionCache(object):
+    '''Completion data kept between TAB presses in a file next to the script
+
+    - index of commands, their aliases and options, rebuilt when script or
+      any module commands were imported from changes
+    - results of completers, reused for ``ttl`` seconds
+
+    ``marshal`` is used, as it needs no import.
+    '''
+
+    def __init__(self, path, ttl=COMPLETION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.dirty = False
+        try:
+            with open(path, 'rb') as f:
+                import marshal
+                self.data = marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            self.data = {}
+
+    @classmethod
+    def for_script(cls, script=None):
+        script = os.path.abspath(script or sys.argv[0])
+        directory, name = os.path.split(script)
+        return cls(os.path.join(directory, '.%s.completion' % name))
+
+    @staticmethod
+    def stamp(paths):
+        stamps = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamps.append((path, st.st_mtime, st.st_size))
+            except OSError:
+                stamps.append((path, None, None))
+        return stamps
+
+    def index(self, cmdtable):
+        '''Returns {'aliases': {alias: key}, 'options': {key: [...]}}'''
+        index = self.data.get('index')
+        if index and self.stamp(p for p, _, _ in index['sources']) == index['sources']:
+            return index
+        aliases, options, modules = {}, {}, set()
+        for key, entry in cmdtable.items():
+            if isinstance(entry, LazyCommand):
+                modules.add(entry.target.split(':', 1)[0])
+                entry = entry.resolve()
+            for alias in aliases_(key):
+                aliases[alias] = key
+            options[key] = [('-%s' % o[0], '--%s' % o[1],
+                             bool(len(o) > 4 and o[4])) for o in entry[1]]
+        sources = [os.path.abspath(sys.argv[0]), __file__.rstrip('co')]
+        sources += [getattr(sys.modules.get(m), '__file__', '').rstrip('co')
+                    for m in sorted(modules)]
+        index = {'aliases': aliases, 'options': options,
+                 'commands': [a for k in cmdtable for a in aliases_(k)],
+                 'sources': self.stamp(sources)}
+        self.data['index'] = index
+        self.dirty = True
+        return index
+
+    def complete(self, key, completer, current):
+        '''Returns memoized ``completer(current)``'''
+        results = self.data.setdefault('results', {})
+        now = time.time()
+        # completers of paths list current directory
+        key = (os.getcwd(),) + tuple(key)
+        cached = results.get(key)
+        if cached and now - cached[0] < self.ttl:
+            return cached[1]
+        value = [str(x) for x in completer(current)]
+        # drop expired results, so the file doesn't grow forever
+        for k in [k for k, v in results.items() if now - v[0] >= self.ttl]:
+            del results[k]
+        results[key] = (now, value)
+        self.dirty = True
+        return value
+
+    def save(self):
+        if not self.dirty:
+            return
+        import marshal
+        try:
+            with open(self.path + '.tmp', 'wb') as f:
+                marshal.dump(self.data, f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            pass  # read-only location, completion still works uncached
+
+
 # Borrowed from PIP
 def autocomplete(cmdtable, args, middleware):
     """Command and option completion.
@@ -727,9 +1039,9 @@ def autocomplete(cmdtable, args, middleware):
     except IndexError:
         current = ''
 
-    commands = []
-    for k in cmdtable.keys():
-        commands += aliases_(k)
+    cache = CompletionCache.for_script()
+    index = cache.index(cmdtable)
+    commands = index['commands']
 
     # command
     if cword == 1:
@@ -739,22 +1051,24 @@ def autocomplete(cmdtable, args, middleware):
     elif cwords[0] in commands:
         idx = -2 if current else -1
         options = []
-        aliases, (cmd, opts, usage) = findcmd(cwords[0], cmdtable)
+        key = index['aliases'][cwords[0]]
 
-        for o in opts:
-            short, long, default, help = o[:4]
-            completer = o[4] if len(o) > 4 else None
-            short, long = '-%s' % short, '--%s' % long
+        for short, long, has_completer in index['options'][key]:
             options += [short, long]
 
-            if cwords[idx] in (short, long) and completer:
+            if cwords[idx] in (short, long) and has_completer:
+                aliases, (cmd, opts, usage) = findcmd(cwords[0], cmdtable)
+                completer = next(o[4] for o in opts
+                                 if '--%s' % o[1] == long)
                 if middleware:
                     completer = middleware(completer)
-                args = completer(current)
+                args = cache.complete((key, long, current), completer,
+                                      current)
                 print ' '.join(args),
 
         print ' '.join((o for o in options if o.startswith(current)))
 
+    cache.save()
     sys.exit(1)
 
 
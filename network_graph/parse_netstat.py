@@ -1,17 +1,60 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import logging
-import socket
+import os
+import stat
+import sys
+import time
 
-from collections import namedtuple, Counter
+from array import array
+from binascii import unhexlify
+from bisect import bisect_right
+from collections import namedtuple, defaultdict, Counter
+from contextlib import closing
+from functools import partial
+from itertools import chain, groupby, islice
+
+from opster import lazy_import
+from profiling import STATS, profiled, timed
+from runtime import RUNTIME, dispatcher
+
+# Not needed by --help, --export and completion
+logging = lazy_import('logging')
+socket = lazy_import('socket')
 
 DC = dict()
+# DC networks as (first address, -last address, DC name) int ranges, sorted so
+# that of networks starting at the same address the widest comes first
+DC_RANGES = list()
+# Index of the innermost network enclosing each of DC_RANGES, -1 if none
+DC_PARENTS = list()
+# Memoized results of get_dc, dropped when it grows above --cache-size entries
+DC_CACHE = dict()
+DC_CACHE_SIZE = 1 << 20
 # XXX(rbtz@): there is also state here, don't use it for now
 NetstatEntry = namedtuple('NetstatEntry', 'proto recv_q send_q local foreign')
+ProcNetTcpEntry = namedtuple('ProcNetTcpEntry', 'sl local remote state queues')
+SsEntry = namedtuple('SsEntry', 'state recv_q send_q local peer')
+# /proc/net/tcp state of listening sockets, netstat shows them with '*' port
+TCP_LISTEN = '0A'
+# Inputs are read (and decompressed) in chunks of this size
+READ_SIZE = 1 << 20
+# Default size of time window for edge aggregation in seconds
+WINDOW = 3600
+# Number of rows fetched from database and written out at once on export
+EXPORT_BATCH = 10000
+# Number of merged edges and windows written to database at once
+WRITE_BATCH = 10000
+# Default number of heaviest edges kept in approximate mode
+TOP_K = 1000
+# Files are split into that many batches per worker in approximate mode,
+# unless --batch-size is given
+SKETCH_BATCHES = 4
+# Number of threads resolving node metadata, it is mostly waiting for DNS
+RESOLVER_THREADS = 32
 
 class Connection(object):
-    def __init__(self, ip_src, port_src, ip_dst=-1, port_dst=-1, rx_q=0, tx_q=0, cnt=1):
+    def __init__(self, ip_src, port_src, ip_dst=-1, port_dst=-1, rx_q=0, tx_q=0, cnt=1, timestamp=0):
         self.ip_src = ip_src
         self.port_src = port_src
         self.ip_dst = ip_dst
@@ -19,6 +62,7 @@ class Connection(object):
         self.rx_q = rx_q
         self.tx_q = tx_q
         self.cnt = cnt
+        self.timestamp = timestamp
 
     def __repr__(self):
         return "Connection({0})".format(', '.join("{0}={1}".format(k, v) for k,v in self.__dict__.items()))
@@ -27,6 +71,7 @@ class Netstat(object):
     __doc__ = """netstat object represents IPv4/IPv6 connections of node"""
     def __init__(self, connections=tuple()):
         self.connections = list()
+        self.snapshots = 0
         for connection in connections:
             self.add_connection(connection)
 
@@ -81,41 +126,281 @@ def parse_netstat(lines):
             logging.debug("Can't add connection to netstat: {0}".format(entry))
     return netstat
 
-def parse_input(filename):
+def decode_proc_addresses(hex_addresses):
     """
-    Function wrapper that opens file, detects type of encoding and passes it
-    line-by-line to netstat parser.
+    Converts /proc/net/tcp{,6} hex addresses to textual form. Kernel prints
+    each 32-bit word of address as a hex integer, so bytes of every word are
+    reversed. Addresses of the same family are swapped in one pass.
+
+    Returns dict of hex address -> ip.
+    """
+    decoded = dict()
+    for family, size in [(socket.AF_INET, 8), (socket.AF_INET6, 32)]:
+        batch = [hex_address for hex_address in hex_addresses if len(hex_address) == size]
+        if not batch:
+            continue
+        words = array('I', unhexlify(''.join(batch)))
+        words.byteswap()
+        packed = words.tostring()
+        step = size // 2
+        for i, hex_address in enumerate(batch):
+            decoded[hex_address] = socket.inet_ntop(family, packed[i * step:(i + 1) * step])
+    return decoded
+
+def parse_proc_net_tcp(lines):
+    """Parse Linux's /proc/net/tcp and /proc/net/tcp6 dumps"""
+    netstat = Netstat()
+
+    entries = list()
+    for line in lines:
+        try:
+            entry = ProcNetTcpEntry(*line.split()[:5])
+            if entry.state == TCP_LISTEN:
+                continue
+            local, port_src = entry.local.split(':')
+            remote, port_dst = entry.remote.split(':')
+            tx_q, rx_q = entry.queues.split(':')
+            entries.append((local, int(port_src, 16), remote, int(port_dst, 16), int(rx_q, 16), int(tx_q, 16)))
+        except Exception:
+            logging.debug("Can't parse /proc/net/tcp line: {0}".format(line.strip()))
+
+    try:
+        addresses = decode_proc_addresses(set(entry[0] for entry in entries) | set(entry[2] for entry in entries))
+    except Exception:
+        logging.debug("Can't decode /proc/net/tcp addresses", exc_info=True)
+        return netstat
+    for local, port_src, remote, port_dst, rx_q, tx_q in entries:
+        connection = Connection(addresses[local], str(port_src), addresses[remote], str(port_dst), rx_q, tx_q)
+        if is_normal_connection(connection):
+            netstat.add_connection(connection)
+    return netstat
+
+def split_ss_address(address):
+    """Splits ``ss`` address like ``[::1]:22`` or ``10.0.0.1%eth0:22`` into ip and port"""
+    ip, port = address.rsplit(':', 1)
+    ip = ip.strip('[]').split('%')[0]
+    return ip, port
+
+def parse_ss(lines):
+    """Parse ``ss -tan`` output"""
+    netstat = Netstat()
+
+    for line in lines:
+        try:
+            entry = SsEntry(*line.split()[:5])
+        except Exception:
+            logging.debug("Can't parse ss line: {0}".format(line.strip()))
+            continue
+        try:
+            ip_src, port_src = split_ss_address(entry.local)
+            ip_dst, port_dst = split_ss_address(entry.peer)
+            connection = Connection(ip_src, port_src, ip_dst, port_dst, int(entry.recv_q), int(entry.send_q))
+            if is_normal_connection(connection):
+                netstat.add_connection(connection)
+        except Exception:
+            logging.debug("Can't add connection to netstat: {0}".format(entry))
+    return netstat
+
+def is_netstat_header(line):
+    return line.startswith('Active Internet connections')
+
+def is_proc_net_tcp_header(line):
+    return line.split()[:2] == ['sl', 'local_address']
+
+def is_ss_header(line):
+    return line.split()[:3] == ['State', 'Recv-Q', 'Send-Q']
+
+# List of (header detector, parser) pairs tried in order by ``parse_input``
+PARSERS = [
+    (is_netstat_header, parse_netstat),
+    (is_proc_net_tcp_header, parse_proc_net_tcp),
+    (is_ss_header, parse_ss),
+]
+# Cheap prefilter for header lines of all formats above
+HEADER_PREFIXES = ('Active Internet', 'sl ', 'State ')
+
+def is_timestamp(line):
+    """Collectors may prefix every snapshot with ``date +%s`` output"""
+    return line.strip().isdigit()
+
+def split_snapshots(lines, timestamp=0):
+    """
+    Groups lines into (timestamp, lines) snapshots. Snapshot starts with
+    ``date +%s`` line or with a header that was already seen in the current
+    snapshot, so ``cat /proc/net/tcp /proc/net/tcp6`` is still one snapshot.
+    """
+    state = dict(snapshot=0, timestamp=timestamp, headers=set())
 
-    FIXME(SaveTheRbtz@): Make it work with gzipped and plaintext pipes.
+    def snapshot(line):
+        if is_timestamp(line):
+            state.update(snapshot=state['snapshot'] + 1, timestamp=int(line), headers=set())
+        elif line.lstrip().startswith(HEADER_PREFIXES):
+            header = tuple(line.split())
+            if header in state['headers']:
+                state.update(snapshot=state['snapshot'] + 1, headers=set())
+            state['headers'].add(header)
+        return state['snapshot'], state['timestamp']
+
+    for (_, timestamp), snapshot_lines in groupby(lines, snapshot):
+        yield timestamp, snapshot_lines
+
+def gzip_decompressor():
+    import zlib
+    # 16 + MAX_WBITS makes zlib expect gzip header and trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def bz2_decompressor():
+    from bz2 import BZ2Decompressor
+    return BZ2Decompressor()
+
+def xz_decompressor():
+    try:
+        from lzma import LZMADecompressor
+    except ImportError:
+        from backports.lzma import LZMADecompressor
+    return LZMADecompressor()
+
+def zstd_decompressor():
+    from zstandard import ZstdDecompressor
+    return ZstdDecompressor().decompressobj()
+
+# List of (magic bytes, decompressor factory) pairs
+COMPRESSORS = [
+    ('\x1f\x8b', gzip_decompressor),
+    ('BZh', bz2_decompressor),
+    ('\xfd7zXZ\x00', xz_decompressor),
+    ('\x28\xb5\x2f\xfd', zstd_decompressor),
+]
+MAGIC_SIZE = max(len(magic) for magic, _ in COMPRESSORS)
+
+def stream_ended(decompressor):
     """
+    Tells if decompressor has seen end of its stream. Decompressors without
+    ``eof`` are probed with one more byte: after the end it is either unused
+    data or EOFError.
+    """
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
     try:
-        from gzip import GzipFile
-        from bz2 import BZ2File
-        first_line = ""
-        for func in [BZ2File, GzipFile, open]:
+        decompressor.decompress('\x00')
+    except EOFError:
+        return True
+    except Exception:
+        return False
+    return bool(getattr(decompressor, 'unused_data', ''))
+
+def decompress(chunks, decompressor_factory):
+    """
+    Decompresses stream of chunks. Handles concatenated streams, e.g. output
+    of ``for i in {0..9}; do netstat -an | gzip; done``. Raises IOError if
+    the last stream is truncated, e.g. file is still being written.
+    """
+    decompressor = decompressor_factory()
+    for data in chunks:
+        while data:
             try:
-                lines = func(filename)
-                first_line = lines.next()
+                chunk = decompressor.decompress(data)
+            except EOFError:
+                # Previous stream ended exactly on a chunk boundary
+                decompressor = decompressor_factory()
+                continue
+            if chunk:
+                yield chunk
+            data = getattr(decompressor, 'unused_data', '')
+            if data:
+                decompressor = decompressor_factory()
+    if not stream_ended(decompressor):
+        raise IOError("Compressed input is truncated")
+
+def split_lines(chunks):
+    """Splits stream of chunks into lines"""
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        STATS.count('lines', len(lines))
+        for line in lines:
+            yield line + '\n'
+    if tail:
+        yield tail
+
+def hash_chunks(chunks, digest):
+    """Passes chunks through while feeding them to ``digest``"""
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+def open_input(filename, digest=None):
+    """
+    Opens file or named pipe and yields its lines. Compression is detected by
+    magic bytes, so input is never reopened and works with non-seekable
+    streams. Raw content is fed to ``digest`` if it is given.
+    """
+    with open(filename, 'rb') as stream:
+        head = stream.read(MAGIC_SIZE)
+        chunks = chain([head], iter(partial(stream.read, READ_SIZE), ''))
+        if digest is not None:
+            chunks = hash_chunks(chunks, digest)
+        for magic, decompressor_factory in COMPRESSORS:
+            if head.startswith(magic):
+                chunks = decompress(chunks, decompressor_factory)
                 break
-            except:
+        for line in split_lines(timed(chunks, 'decompress')):
+            yield line
+
+def parse_input(filename, digest=None, timestamp=0):
+    """
+    Function wrapper that opens file, detects type of encoding and passes it
+    snapshot-by-snapshot to parser chosen by the first line of input:
+    ``netstat -an``, ``/proc/net/tcp{,6}`` dump or ``ss -tan``.
+
+    Connections are stamped with time of their snapshot, ``timestamp`` is
+    used for snapshots without ``date +%s`` line before them.
+
+    Returns Netstat without snapshots for input of unknown format and None
+    if it could not be read.
+    """
+    try:
+        with STATS.stage('parse'):
+            lines = open_input(filename, digest=digest)
+            first_line = next(lines, '')
+            if is_timestamp(first_line):
+                timestamp = int(first_line)
+                first_line = next(lines, '')
+            for is_header, parser in PARSERS:
+                if is_header(first_line):
+                    netstat = Netstat()
+                    for snapshot_time, snapshot in split_snapshots(chain([first_line], lines), timestamp):
+                        for connection in parser(snapshot).connections:
+                            connection.timestamp = snapshot_time
+                            netstat.add_connection(connection)
+                        netstat.snapshots += 1
+                    # Drain input so digest covers the whole file
+                    for _ in lines:
+                        pass
+                    return netstat
+            logging.warning("File does not seem to be a ``netstat -an``, ``ss -tan`` or /proc/net/tcp output: {0}".format(first_line.strip()))
+            for _ in lines:
                 pass
-        else:
-            logging.error("Can't open file: {0}".format(filename), exc_info=True)
             return Netstat()
-        if first_line.startswith('Active Internet connections'):
-            return parse_netstat(lines)
-        else:
-            logging.warning("File does not seem to be a ``netstat -an`` output: {0}".format(first_line.strip()))
     except Exception:
         logging.error("Can't parse file: {0}".format(filename), exc_info=True)
 
-def group_netstat(netstat):
-    """Computes weights of connections (simply by counting them)"""
-    output = dict(nodes=set(), edges=list())
+def group_netstat(netstat, window=WINDOW):
+    """
+    Computes weights of connections (simply by counting them) and, per time
+    window, their weights and sums of receive and send queues
+    """
+    output = dict(nodes=set(), edges=list(), windows=list(), snapshots=netstat.snapshots)
     weights = Counter()
+    windows = defaultdict(lambda: [0, 0, 0])
 
     for connection in netstat.connections:
         weights[(connection.ip_src, connection.ip_dst)] += 1
+        stats = windows[(connection.timestamp - connection.timestamp % window, connection.ip_src, connection.ip_dst)]
+        stats[0] += 1
+        stats[1] += connection.rx_q
+        stats[2] += connection.tx_q
         for node in [connection.ip_src, connection.ip_dst]:
             output['nodes'].add(node)
 
@@ -123,15 +408,113 @@ def group_netstat(netstat):
         # This is really ALOT of resolving. Should cache it somewhere... but am
         # an Admin, so just setup local unbound for now
         output['edges'].append((ip_src, ip_dst, weights[(ip_src, ip_dst)]))
+    for (start, ip_src, ip_dst), (weight, recv_q, send_q) in windows.iteritems():
+        output['windows'].append((start, ip_src, ip_dst, weight, recv_q, send_q))
     return output
 
-def file_to_dict(filename):
-    """Simple function composition"""
+def file_stat(filename):
+    """Returns (size, mtime) of regular file or None for pipes and such"""
     try:
-        return group_netstat(parse_input(filename))
+        st = os.stat(filename)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_size, st.st_mtime
+
+@profiled
+def file_to_dict(filename, window=WINDOW):
+    """
+    Simple function composition. Result also carries file's fingerprint, so
+    its contribution to the graph can be tracked in the manifest, and stats
+    of the worker.
+
+    Snapshots without ``date +%s`` line are considered taken at file's mtime.
+    Files of unknown format have no edges, but are still fingerprinted, so
+    they are not parsed again until they change. Files which failed to be
+    read are not fingerprinted and are retried by the next run.
+    """
+    started = time.time()
+    result = dict()
+    try:
+        from hashlib import sha1
+        fingerprint = file_stat(filename)
+        digest = sha1()
+        timestamp = int(fingerprint[1]) if fingerprint is not None else int(time.time())
+        netstat = parse_input(filename, digest=digest, timestamp=timestamp)
+        if netstat is None:
+            raise IOError("Can't read {0}".format(filename))
+        STATS.count('files' if netstat.snapshots else 'unknown_files')
+        with STATS.stage('group'):
+            result = group_netstat(netstat, window=window)
+        if fingerprint is not None:
+            result.update(filename=filename, size=fingerprint[0], mtime=fingerprint[1], digest=digest.hexdigest())
     except Exception:
         logging.warning("Failed to parse: {0}".format(filename))
+        STATS.count('failed_files')
+    STATS.count('busy', time.time() - started)
+    result['stats'] = STATS.reset()
+    return result
+
+def pending_files(filenames, filename='', force=False):
+    """
+    Filters out files which have same size and mtime as recorded in the
+    manifest. Files that are not regular (e.g. named pipes) are always
+    processed.
+    """
+    if force or not filename:
+        return list(filenames)
+    from sqlite3 import connect
+    conn = connect(filename)
+    manifest = dict((path, (size, mtime)) for path, size, mtime in conn.execute('select path, size, mtime from files'))
+    conn.close()
+    pending = list()
+    for name in filenames:
+        fingerprint = file_stat(name)
+        if fingerprint is None or manifest.get(name) != fingerprint:
+            pending.append(name)
+        else:
+            logging.debug("Skipping unchanged file: {0}".format(name))
+    return pending
+
+@profiled
+def files_to_sketch(filenames, k=TOP_K):
+    """Aggregates batch of files into fixed size ``EdgeSketch``, returns it with stats"""
+    from sketches import EdgeSketch
+    from profiling import Stats
+    sketch = EdgeSketch(k=k)
+    stats = Stats()
+    for filename in filenames:
+        result = file_to_dict(filename)
+        started = time.time()
+        with STATS.stage('sketch'):
+            for ip_src, ip_dst, weight in result.get('edges', []):
+                sketch.add(ip_src, ip_dst, weight)
+        STATS.count('busy', time.time() - started)
+        stats.merge(result['stats']).merge(STATS.reset())
+    return sketch, stats
+
+def sketch_files(pool, filenames, k=TOP_K):
+    """
+    Approximately aggregates files in fixed memory. Each worker task returns
+    sketch of a batch of files, which are merged as they arrive. Returns
+    result with only heaviest edges and nodes connected by them.
+    """
+    if RUNTIME.batch_size:
+        n = (len(filenames) + RUNTIME.batch_size - 1) // RUNTIME.batch_size
+    else:
+        n = RUNTIME.workers * SKETCH_BATCHES
+    batches = [filenames[i::n] for i in xrange(n)]
+    sketch = None
+    for batch_sketch, stats in timed(pool.imap_unordered(partial(files_to_sketch, k=k), [batch for batch in batches if batch]), 'wait'):
+        STATS.merge(stats)
+        with STATS.stage('merge'):
+            sketch = batch_sketch if sketch is None else sketch.merge(batch_sketch)
+    if sketch is None:
         return dict()
+    logging.warning("Approximate number of nodes: {0:.0f}".format(sketch.nodes.count()))
+    edges = sketch.edges()
+    return dict(nodes=set(node for edge in edges for node in edge[:2]), edges=edges)
 
 def cache_dc(dc_cache_filename):
     """
@@ -141,10 +524,20 @@ def cache_dc(dc_cache_filename):
     try:
         global DC
         from ipaddr import IPv4Network
+        DC_CACHE.clear()
         with open(dc_cache_filename) as lines:
             for line in lines:
                 dc_name, dc_net = line.split()[:2]
                 DC[IPv4Network(dc_net)] = dc_name
+        DC_RANGES[:] = sorted((int(dc_net.network), -int(dc_net.broadcast), dc_name) for dc_net, dc_name in DC.items())
+        # Networks are either nested or disjoint, so enclosing ones form a stack
+        enclosing = list()
+        del DC_PARENTS[:]
+        for idx, (first, _, _) in enumerate(DC_RANGES):
+            while enclosing and -DC_RANGES[enclosing[-1]][1] < first:
+                enclosing.pop()
+            DC_PARENTS.append(enclosing[-1] if enclosing else -1)
+            enclosing.append(idx)
         return True
     except Exception:
         logging.warning("Failed to load DC cache", exc_info=True)
@@ -155,35 +548,243 @@ def get_dc(ip):
     global DC
     if not DC:
         return ''
+    if ip in DC_CACHE:
+        return DC_CACHE[ip]
+    dc = ''
     try:
         from ipaddr import IPv4Address
-        for dc_net, dc_name in DC.items():
-            if IPv4Address(ip) in dc_net:
-                return dc_name
+        address = int(IPv4Address(ip))
+        # Network containing address either is the last one starting at or
+        # before it or encloses that one, so only enclosing networks are
+        # checked, innermost first
+        idx = bisect_right(DC_RANGES, (address, 1, '')) - 1
+        while idx >= 0:
+            _, last, dc_name = DC_RANGES[idx]
+            if address <= -last:
+                dc = dc_name
+                break
+            idx = DC_PARENTS[idx]
     except Exception:
         logging.debug("Failed to load {0}'s DC from cache".format(ip), exc_info=True)
+    if len(DC_CACHE) >= RUNTIME.cache(DC_CACHE_SIZE):
+        DC_CACHE.clear()
+    DC_CACHE[ip] = dc
+    return dc
+
+def subnet(ip):
+    """Returns IP's /24 network for IPv4 or /64 for IPv6"""
+    try:
+        if ':' in ip:
+            packed = socket.inet_pton(socket.AF_INET6, ip)
+            return socket.inet_ntop(socket.AF_INET6, packed[:8] + '\x00' * 8) + '/64'
+        packed = socket.inet_aton(ip)
+        return socket.inet_ntoa(packed[:3] + '\x00') + '/24'
+    except Exception:
         return ''
 
-def save_results(results, filename=''):
-    """Save data to file"""
+# Rollup tables and functions mapping node to its group
+ROLLUPS = [
+    ('dc_edges', get_dc),
+    ('subnet_edges', subnet),
+]
+
+def add_edges(c, edges, table='edges'):
+    """Adds weights of (source, target, weight) edges to the edges table"""
+    edges = list(edges)
+    c.executemany('''insert or ignore into {0} values (?,?,0)'''.format(table), ((source, target) for source, target, _ in edges))
+    c.executemany('''update {0} set weight = weight + ? where source = ? and target = ?'''.format(table),
+                  ((weight, source, target) for source, target, weight in edges))
+    if table == 'edges':
+        add_rollups(c, edges)
+
+def add_rollups(c, edges):
+    """Adds weights of edges to DC-to-DC and subnet-to-subnet rollup tables"""
+    for table, group in ROLLUPS:
+        weights = Counter()
+        for source, target, weight in edges:
+            weights[(group(source), group(target))] += weight
+        add_edges(c, ((source, target, weight) for (source, target), weight in weights.iteritems()), table=table)
+
+def rebuild_rollups(filename):
+    """
+    Recomputes rollup tables from the edges table, e.g. after network layout
+    file was changed
+    """
+    from sqlite3 import connect
+    conn = connect(filename)
+    for table, group in ROLLUPS:
+        conn.execute('''delete from {0}'''.format(table))
+        fill_rollup(conn, table, group)
+    conn.commit()
+    conn.close()
+
+def fill_rollup(conn, table, group):
+    """Inserts weights of the edges table grouped by group() into empty rollup table"""
+    conn.create_function(group.__name__, 1, group)
+    conn.execute('''insert into {0} select {1}(source), {1}(target), sum(weight) from edges group by 1, 2'''.format(
+                 table, group.__name__))
+
+def add_windows(c, windows):
+    """Adds (window, source, target, weight, recv_q, send_q) to the edge_windows table"""
+    windows = list(windows)
+    c.executemany('''insert or ignore into edge_windows values (?,?,?,0,0,0)''',
+                  ((window, source, target) for window, source, target, _, _, _ in windows))
+    c.executemany('''update edge_windows set weight = weight + ?, recv_q = recv_q + ?, send_q = send_q + ?
+                     where window = ? and source = ? and target = ?''',
+                  ((weight, recv_q, send_q, window, source, target)
+                   for window, source, target, weight, recv_q, send_q in windows))
+
+def retract_file(c, path):
+    """Subtracts file's previous contribution from the edges and edge_windows tables"""
+    c.execute('''select source, target, -sum(weight) from file_edges where path = ? group by source, target''', (path,))
+    edges = c.fetchall()
+    if not edges:
+        return
+    add_edges(c, edges)
+    c.execute('''select window, source, target, -weight, -recv_q, -send_q from file_edges
+                 where path = ? and window is not null''', (path,))
+    windows = c.fetchall()
+    add_windows(c, windows)
+    c.execute('''delete from file_edges where path = ?''', (path,))
+    # Only retracted keys can drop to zero, so drop them by index instead of scanning whole tables
+    c.executemany('''delete from edges where source = ? and target = ? and weight <= 0''',
+                  ((source, target) for source, target, _ in edges))
+    for table, group in ROLLUPS:
+        c.executemany('''delete from {0} where source = ? and target = ? and weight <= 0'''.format(table),
+                      set((group(source), group(target)) for source, target, _ in edges))
+    c.executemany('''delete from edge_windows where window = ? and source = ? and target = ? and weight <= 0''',
+                  (window[:3] for window in windows))
+
+def enrich_node(node, resolve=True):
+    """Returns nodes table row for node"""
+    with STATS.stage('resolve'):
+        label = resolve and short_hostname(hostname(node)) or node
+    with STATS.stage('dc'):
+        dc = get_dc(node)
+    return node, label, dc
+
+class NodeEnricher(object):
+    __doc__ = """
+    Resolves metadata of every new node once, in background threads, so
+    edges can be saved while DNS is being queried
+    """
+    def __init__(self, known=(), threads=RESOLVER_THREADS, resolve=True):
+        from multiprocessing.pool import ThreadPool
+        self.seen = set(known)
+        self.enrich = partial(enrich_node, resolve=resolve)
+        self.pool = ThreadPool(threads)
+        self.pending = list()
+
+    def add(self, nodes):
+        new_nodes = [node for node in nodes if node not in self.seen]
+        self.seen.update(new_nodes)
+        if new_nodes:
+            self.pending.append((len(new_nodes), self.pool.map_async(self.enrich, new_nodes)))
+        STATS.gauge('nodes_backlog', sum(size for size, result in self.pending if not result.ready()))
+
+    def rows(self):
+        """Waits for resolution to finish and returns nodes table rows"""
+        self.pool.close()
+        self.pool.join()
+        return [row for _, result in self.pending for row in result.get()]
+
+def save_result(c, result, enricher, edges, windows, force=False):
+    """
+    Saves file manifest of single result with cursor, its edges and windows
+    are added to aggregators, new nodes are passed to enricher. Results with
+    unchanged content are skipped unless ``force`` is set.
+    """
+    path = result.get('filename')
+    if path is not None:
+        c.execute('''select digest from files where path = ?''', (path,))
+        row = c.fetchone()
+        c.execute('''insert or replace into files values (?,?,?,?)''',
+                  (path, result['size'], result['mtime'], result['digest']))
+        if not force and row is not None and row[0] == result['digest']:
+            logging.debug("File content is unchanged: {0}".format(path))
+            return
+        retract_file(c, path)
+        c.executemany('''insert into file_edges values (?,?,?,?,?,?,?)''',
+                      ((path,) + tuple(window) for window in result.get('windows', [])))
+    enricher.add(result.get('nodes', []))
+    edges.update(((source, target), weight) for source, target, weight in result.get('edges', []))
+    windows.update((tuple(window[:3]), tuple(window[3:])) for window in result.get('windows', []))
+
+def write_aggregated(c, aggregated, add_rows):
+    """Writes merged (key, value) items of aggregator in batches, in key order"""
+    items = timed(aggregated.items(), 'merge')
+    while True:
+        rows = [key + (value if isinstance(value, tuple) else (value,)) for key, value in islice(items, WRITE_BATCH)]
+        if not rows:
+            break
+        with STATS.stage('write'):
+            add_rows(c, rows)
+
+def save_results(results, filename='', resolve=True, force=False):
+    """
+    Save data to file. Results of regular files replace their previous
+    contribution, results with unchanged content are only re-fingerprinted
+    unless ``force`` is set.
+    Edge and window weights of all results are summed in memory budget
+    (spilling sorted runs to disk) and written once per key at the end.
+    Nodes are enriched in background and written in one pass at the end.
+    Nothing is committed if any write fails, so files are retried next run.
+    """
+    if not filename:
+        return False
+    conn = None
+    try:
+        from sqlite3 import connect
+        from external import ExternalAggregator, add_vectors
+        conn = connect(filename)
+        c = conn.cursor()
+        enricher = NodeEnricher(known=(row[0] for row in c.execute('''select id from nodes''')), resolve=resolve)
+        with ExternalAggregator() as edges, ExternalAggregator(combine=add_vectors) as windows:
+            for result in timed(results, 'wait'):
+                if 'stats' in result:
+                    STATS.merge(result.pop('stats'))
+                with STATS.stage('write'):
+                    save_result(c, result, enricher, edges, windows, force=force)
+            if edges.spills or windows.spills:
+                STATS.count('spills', edges.spills + windows.spills)
+            write_aggregated(c, edges, add_edges)
+            write_aggregated(c, windows, add_windows)
+        with STATS.stage('wait_nodes'):
+            rows = enricher.rows()
+        with STATS.stage('write'):
+            c.executemany('''insert or ignore into nodes values (?,?,?)''', rows)
+            conn.commit()
+        c.close()
+        return True
+    except Exception:
+        logging.warning("Can't save result to DB!", exc_info=True)
+        if conn is not None:
+            # Manifest of files whose edges were not written is dropped too
+            conn.rollback()
+        return False
+
+def save_approximate(result, filename='', resolve=True):
+    """
+    Replaces contents of the approx_edges table with edges of sketch result.
+    Estimates can't be retracted or mixed with exact weights, so the edges
+    table, rollups and manifest are left intact.
+    """
     if not filename:
         return False
     try:
         from sqlite3 import connect
         conn = connect(filename)
         c = conn.cursor()
-        for result in results:
-            for node in result.get('nodes', []):
-                try:
-                    c.execute('''insert into nodes values (?,?,?)''', (node, short_hostname(hostname(node)) or node, get_dc(node)))
-                except Exception as e:
-                    logging.info("Could not insert row in nodes table: {0}".format(e))
-            for edge in result.get('edges', []):
-                try:
-                    c.execute('''insert into edges values (?,?,?)''', edge)
-                except Exception as e:
-                    logging.info("Could not insert row in edges table: {0}".format(e))
-        conn.commit()
+        enricher = NodeEnricher(known=(row[0] for row in c.execute('''select id from nodes''')), resolve=resolve)
+        enricher.add(result.get('nodes', []))
+        with STATS.stage('write'):
+            c.execute('''delete from approx_edges''')
+            c.executemany('''insert into approx_edges values (?,?,?)''', result.get('edges', []))
+        with STATS.stage('wait_nodes'):
+            rows = enricher.rows()
+        with STATS.stage('write'):
+            c.executemany('''insert or ignore into nodes values (?,?,?)''', rows)
+            conn.commit()
         c.close()
         return True
     except Exception:
@@ -191,21 +792,201 @@ def save_results(results, filename=''):
         return False
 
 def prepare_database(filename):
-    """Prepares database for usage"""
+    """Prepares database for usage, DC layout should be loaded by cache_dc() before"""
     from sqlite3 import connect
     conn = connect(filename)
     c = conn.cursor()
     c.execute("create table if not exists nodes (id string, label string, dc string)");
     c.execute("create unique index if not exists id_idx on nodes (id)");
     c.execute("create table if not exists edges (source string, target string, weight real)");
+    c.execute("select 1 from sqlite_master where type = 'index' and name = 'edges_idx'")
+    if c.fetchone() is None:
+        # Databases filled before the manifest have duplicate edges
+        c.execute("create temp table merged_edges as select source, target, sum(weight) from edges group by source, target")
+        c.execute("delete from edges")
+        c.execute("insert into edges select * from merged_edges")
+        c.execute("drop table merged_edges")
+    c.execute("create unique index if not exists edges_idx on edges (source, target)");
+    c.execute("create index if not exists edges_target_idx on edges (target)");
+    for table, group in ROLLUPS:
+        c.execute("select 1 from sqlite_master where type = 'table' and name = ?", (table,))
+        created = c.fetchone() is None
+        c.execute("create table if not exists {0} (source string, target string, weight real)".format(table));
+        c.execute("create unique index if not exists {0}_idx on {0} (source, target)".format(table));
+        if created:
+            # Rollups added to database filled before them start from its edges
+            fill_rollup(conn, table, group)
+    # Manifest of processed files and their contributions to the edges table
+    c.execute("create table if not exists files (path string primary key, size integer, mtime real, digest string)");
+    c.execute("pragma table_info(file_edges)")
+    columns = [column[1] for column in c.fetchall()]
+    if columns and 'window' not in columns:
+        # Manifest written before time windows has only per-file edges. Their
+        # windows are unknown (NULL) and never were in edge_windows
+        logging.warning("Migrating manifest to time windows, use --force to add windows of already processed files")
+        c.execute("alter table file_edges rename to file_edges_old")
+        c.execute("drop index if exists file_edges_path_idx")
+        c.execute("create table file_edges (path string, window integer, source string, target string, weight real, recv_q integer, send_q integer)");
+        c.execute("insert into file_edges select path, null, source, target, weight, 0, 0 from file_edges_old")
+        c.execute("drop table file_edges_old")
+    c.execute("create table if not exists file_edges (path string, window integer, source string, target string, weight real, recv_q integer, send_q integer)");
+    c.execute("create index if not exists file_edges_path_idx on file_edges (path)");
+    # Heaviest edges of the last --approximate run with estimated weights
+    c.execute("create table if not exists approx_edges (source string, target string, weight real)");
+    # Per time window edges, clustered by window start for range queries
+    c.execute("""create table if not exists edge_windows (window integer, source string, target string,
+                 weight real, recv_q integer, send_q integer, primary key (window, source, target)) without rowid""");
     conn.commit()
     c.close()
 
-from opster import command
-@command()
+def graph_for_range(filename, start=None, end=None):
+    """
+    Yields (source, target, weight, recv_q, send_q) edges aggregated over
+    windows which start in [start, end) range. Open bounds are unlimited.
+    """
+    from sqlite3 import connect
+    conn = connect(filename)
+    query = '''select source, target, sum(weight), sum(recv_q), sum(send_q) from edge_windows
+               where window >= ? and window < ? group by source, target'''
+    for row in conn.execute(query, (start if start is not None else -2 ** 63, end if end is not None else 2 ** 63 - 1)):
+        yield row
+    conn.close()
+
+def graph_rows(conn, start=None, end=None, approximate=False):
+    """
+    Returns (nodes, edges) cursors for whole graph or, if time range is
+    given, for edges of windows in [start, end) and nodes they connect.
+    Approximate graph is the one saved by the last --approximate run.
+    """
+    if approximate:
+        return (conn.execute('''select id, label, dc from nodes where id in
+                                (select source from approx_edges union select target from approx_edges)'''),
+                conn.execute('''select source, target, weight from approx_edges'''))
+    if start is None and end is None:
+        return (conn.execute('''select id, label, dc from nodes'''),
+                conn.execute('''select source, target, weight from edges'''))
+    bounds = (start if start is not None else -2 ** 63, end if end is not None else 2 ** 63 - 1)
+    nodes = conn.execute('''select id, label, dc from nodes where id in
+                           (select source from edge_windows where window >= ? and window < ?
+                            union select target from edge_windows where window >= ? and window < ?)''', bounds * 2)
+    edges = conn.execute('''select source, target, sum(weight) from edge_windows
+                           where window >= ? and window < ? group by source, target''', bounds)
+    return nodes, edges
+
+def batches(cursor, size=EXPORT_BATCH):
+    """Yields lists of rows fetched from cursor"""
+    return iter(partial(cursor.fetchmany, size), [])
+
+def write_rows(out, rows):
+    """Writes list of formatted rows in one call"""
+    out.write(u''.join(rows).encode('utf-8'))
+
+def gdf_value(value):
+    """Quotes GDF string value"""
+    return u"'{0}'".format(unicode(value).replace(u"'", u"\\'"))
+
+def export_gdf(out, nodes, edges):
+    """Writes nodes and edges in GDF format"""
+    out.write('nodedef>name VARCHAR,label VARCHAR,dc VARCHAR\n')
+    for rows in batches(nodes):
+        write_rows(out, (u','.join(gdf_value(value or '') for value in row) + u'\n' for row in rows))
+    out.write('edgedef>node1 VARCHAR,node2 VARCHAR,weight DOUBLE\n')
+    for rows in batches(edges):
+        write_rows(out, (u'{0},{1},{2}\n'.format(gdf_value(source), gdf_value(target), weight) for source, target, weight in rows))
+
+def export_gexf(out, nodes, edges):
+    """Writes nodes and edges in GEXF format, without building a DOM"""
+    from xml.sax.saxutils import quoteattr
+    out.write('''<?xml version="1.0" encoding="UTF-8"?>
+<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">
+  <graph mode="static" defaultedgetype="directed">
+    <attributes class="node">
+      <attribute id="0" title="dc" type="string"/>
+    </attributes>
+    <nodes>
+''')
+    for rows in batches(nodes):
+        write_rows(out, (u'      <node id={0} label={1}><attvalues><attvalue for="0" value={2}/></attvalues></node>\n'.format(
+                             quoteattr(id_), quoteattr(label or id_), quoteattr(dc or u'')) for id_, label, dc in rows))
+    out.write('''    </nodes>
+    <edges>
+''')
+    edge_id = 0
+    for rows in batches(edges):
+        write_rows(out, (u'      <edge id="{0}" source={1} target={2} weight="{3}"/>\n'.format(
+                             edge_id + i, quoteattr(source), quoteattr(target), weight)
+                         for i, (source, target, weight) in enumerate(rows)))
+        edge_id += len(rows)
+    out.write('''    </edges>
+  </graph>
+</gexf>
+''')
+
+def export_edgelist(out, nodes, edges):
+    """Writes tab separated edge list"""
+    for rows in batches(edges):
+        write_rows(out, (u'{0}\t{1}\t{2}\n'.format(*row) for row in rows))
+
+# Exporters by file extension, anything else is exported as edge list
+EXPORTERS = {
+    '.gdf': export_gdf,
+    '.gexf': export_gexf,
+}
+
+def export_graph(filename, export_filename, start=None, end=None, approximate=False):
+    """
+    Streams graph from database to ``export_filename``. Format is chosen by
+    extension, ``.gz`` or ``.bz2`` suffix compresses output.
+    """
+    try:
+        from sqlite3 import connect
+        conn = connect(filename)
+        name, extension = os.path.splitext(export_filename)
+        if extension == '.gz':
+            from gzip import GzipFile as output
+        elif extension == '.bz2':
+            from bz2 import BZ2File as output
+        else:
+            output, name = open, export_filename
+        exporter = EXPORTERS.get(os.path.splitext(name)[1], export_edgelist)
+        nodes, edges = graph_rows(conn, start, end, approximate)
+        with closing(output(export_filename, 'wb')) as out:
+            exporter(out, nodes, edges)
+        conn.close()
+        return True
+    except Exception:
+        logging.warning("Can't export graph to {0}".format(export_filename), exc_info=True)
+        return False
+
+def track_backlog(results, total):
+    """Records number of tasks not yet completed as each result arrives"""
+    for received, result in enumerate(results, 1):
+        STATS.gauge('tasks_backlog', total - received)
+        yield result
+
+def write_stats(wall, workers, stats_json=''):
+    """Prints run stats to stderr and optionally dumps them as JSON"""
+    sys.stderr.write(STATS.report(wall, workers))
+    if stats_json:
+        import json
+        with open(stats_json, 'w') as out:
+            json.dump(STATS.summary(wall, workers), out, indent=2, sort_keys=True)
+
+cli = dispatcher()
+@cli.command()
 def main(output=('o', 'output/graph.db', 'sqlite database to put data to'),
         network_cache=('c', 'networks.txt', 'file with network layout partitioned by dc (optional)'),
         verbose=('v', False, 'be verbose'),
+        force=('f', False, 'reprocess files even if they are unchanged since last run'),
+        window=('w', WINDOW, 'size of time window for edge aggregation in seconds'),
+        export=('e', '', 'export graph to .gdf, .gexf or edge list file, add .gz or .bz2 to compress'),
+        since=('', 0, 'export only windows starting at or after this unix time'),
+        until=('', 0, 'export only windows starting before this unix time'),
+        rebuild=('', False, 'recompute DC and subnet rollups from edges, e.g. after network layout change'),
+        approximate=('a', False, 'aggregate in fixed memory with sketches, only heaviest edges are saved to approx_edges'),
+        top_k=('k', TOP_K, 'number of heaviest edges saved in approximate mode'),
+        stats_json=('', '', 'also write per-stage run statistics to this file as JSON'),
+        no_resolve=('', False, 'label nodes by ip instead of reverse DNS name'),
         *filenames):
     """Convert network statistics to GDF format"""
 
@@ -214,14 +995,27 @@ def main(output=('o', 'output/graph.db', 'sqlite database to put data to'),
         severity=logging.DEBUG
     logging.basicConfig(level=severity)
 
-    prepare_database(output)
+    started = time.time()
     cache_dc(network_cache)
+    prepare_database(output)
+
+    pool = RUNTIME.pool()
+    if approximate:
+        save_approximate(sketch_files(pool, list(filenames), k=top_k), filename=output, resolve=not no_resolve)
+    else:
+        filenames = pending_files(filenames, filename=output, force=force)
+        logging.info("Processing {0} new or changed files".format(len(filenames)))
+        results = pool.imap_unordered(partial(file_to_dict, window=window), filenames,
+                                      chunksize=RUNTIME.batch(1))
+        save_results(track_backlog(results, len(filenames)), filename=output, resolve=not no_resolve, force=force)
+    pool.close()
+    pool.join()
+    write_stats(time.time() - started, RUNTIME.workers, stats_json)
 
-    from multiprocessing import Pool
-    pool = Pool()
-    r = pool.map_async(file_to_dict, filenames)
-    while not r.ready():
-        save_results(r.get(), filename=output)
+    if rebuild:
+        rebuild_rollups(output)
+    if export:
+        export_graph(output, export, start=since or None, end=until or None, approximate=approximate)
 
 if __name__ == '__main__':
     main.command()
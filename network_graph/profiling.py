@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight per-stage instrumentation: wall and CPU time of named stages,
+counters and queue depth gauges. Stats are plain data, so workers can send
+them back with their results to be merged in the parent process.
+"""
+
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+# Directory for per-worker cProfile dumps, profiling is off when empty
+PROFILE_DIR = None
+_profiler = None
+_profiling = threading.local()
+
+
+def cpu_time():
+    """User + system CPU time of current process"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Stats(object):
+    __doc__ = """
+    Accumulates exclusive wall and CPU time per stage: time of nested stage
+    is not counted in the enclosing one. CPU time is process-wide, so for
+    stages run in threads it is only an approximation.
+    """
+    def __init__(self):
+        self.stages = dict()
+        self.counters = dict()
+        self.gauges = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return dict(stages=self.stages, counters=self.counters, gauges=self.gauges)
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+
+    @contextmanager
+    def stage(self, name):
+        stack = self._local.__dict__.setdefault('stack', list())
+        stack.append([0.0, 0.0])
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - wall, cpu_time() - cpu
+            nested_wall, nested_cpu = stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            self.add(name, wall - nested_wall, cpu - nested_cpu)
+
+    def add(self, name, wall, cpu, calls=1):
+        with self._lock:
+            stage = self.stages.setdefault(name, [0.0, 0.0, 0])
+            stage[0] += wall
+            stage[1] += cpu
+            stage[2] += calls
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """Records sample of e.g. queue depth, max and mean are reported"""
+        with self._lock:
+            gauge = self.gauges.setdefault(name, [0, 0, 0])
+            gauge[0] = max(gauge[0], value)
+            gauge[1] += value
+            gauge[2] += 1
+
+    def merge(self, other):
+        for name, (wall, cpu, calls) in other.stages.items():
+            self.add(name, wall, cpu, calls)
+        for name, value in other.counters.items():
+            self.count(name, value)
+        with self._lock:
+            for name, (maximum, total, samples) in other.gauges.items():
+                gauge = self.gauges.setdefault(name, [0, 0, 0])
+                gauge[0] = max(gauge[0], maximum)
+                gauge[1] += total
+                gauge[2] += samples
+        return self
+
+    def reset(self):
+        """Returns copy of accumulated stats and starts from scratch"""
+        with self._lock:
+            stats = Stats()
+            stats.__setstate__(self.__getstate__())
+            self.stages, self.counters, self.gauges = dict(), dict(), dict()
+        return stats
+
+    def summary(self, wall, workers=1):
+        """Returns dict with stages, counters, rates and gauges"""
+        summary = dict(wall=wall, workers=workers,
+                       stages=dict((name, dict(wall=w, cpu=c, calls=n)) for name, (w, c, n) in self.stages.items()),
+                       counters=dict(self.counters),
+                       gauges=dict((name, dict(max=m, mean=float(t) / n if n else 0))
+                                   for name, (m, t, n) in self.gauges.items()))
+        if wall:
+            summary['rates'] = dict(("{0}/s".format(name), value / wall) for name, value in self.counters.items())
+        if 'busy' in self.counters and wall and workers:
+            summary['worker_utilization'] = self.counters['busy'] / (wall * workers)
+        return summary
+
+    def report(self, wall, workers=1):
+        """Returns human readable summary"""
+        summary = self.summary(wall, workers)
+        lines = ["{0:<12} {1:>10} {2:>10} {3:>10}".format('stage', 'wall, s', 'cpu, s', 'calls')]
+        for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall']):
+            lines.append("{0:<12} {1:>10.3f} {2:>10.3f} {3:>10}".format(name, stage['wall'], stage['cpu'], stage['calls']))
+        lines.append("total wall time: {0:.3f}s".format(wall))
+        for name, rate in sorted(summary.get('rates', {}).items()):
+            if name == 'busy/s':
+                continue
+            lines.append("{0}: {1} ({2:.1f})".format(name[:-2], summary['counters'][name[:-2]], rate))
+        if 'worker_utilization' in summary:
+            lines.append("worker utilization: {0:.1%} of {1} workers".format(summary['worker_utilization'], workers))
+        for name, gauge in sorted(summary['gauges'].items()):
+            lines.append("{0}: max {1}, mean {2:.1f}".format(name, gauge['max'], gauge['mean']))
+        return '\n'.join(lines) + '\n'
+
+
+# Stats of current process
+STATS = Stats()
+
+
+def timed(iterable, name, stats=STATS):
+    """Accounts time spent producing each item of iterable to stage ``name``"""
+    iterator = iter(iterable)
+    while True:
+        with stats.stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def enable_profiling(directory):
+    """Makes functions decorated with ``profiled`` run under cProfile"""
+    global PROFILE_DIR
+    PROFILE_DIR = directory
+
+
+def profile_main(func, *args, **kwargs):
+    """
+    Runs func under cProfile, stats are dumped to PROFILE_DIR/main-<pid>.prof.
+    Functions decorated with ``profiled`` are accounted there when called in
+    this process.
+    """
+    from cProfile import Profile
+    profiler = Profile()
+    _profiling.active = True
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        _profiling.active = False
+        profiler.dump_stats(os.path.join(PROFILE_DIR, 'main-{0}.prof'.format(os.getpid())))
+
+
+def worker_init():
+    """Pool initializer: forked worker drops profiler inherited from its parent"""
+    global _profiler
+    sys.setprofile(None)
+    _profiler = None
+    _profiling.active = False
+
+
+def profiled(func):
+    """
+    Runs function under per-process cProfile if profiling is enabled. Stats
+    accumulate over calls and are dumped to PROFILE_DIR/worker-<pid>.prof
+    once, when process exits.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        global _profiler
+        if PROFILE_DIR is None or getattr(_profiling, 'active', False):
+            return func(*args, **kwargs)
+        if _profiler is None:
+            from cProfile import Profile
+            from multiprocessing.util import Finalize
+            _profiler = Profile()
+            # Run by pool workers on exit and by atexit in parent process
+            Finalize(None, _profiler.dump_stats, args=(os.path.join(PROFILE_DIR, 'worker-{0}.prof'.format(os.getpid())),),
+                     exitpriority=0)
+        _profiling.active = True
+        try:
+            return _profiler.runcall(func, *args, **kwargs)
+        finally:
+            _profiling.active = False
+    return wrapper
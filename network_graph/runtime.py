@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Runtime settings shared by command line tools: number of worker processes,
+batch and cache sizes, memory limit and profiling. Commands registered on
+``dispatcher()`` accept the same global options, tools read them from
+``RUNTIME`` instead of hard-coded constants, so every deployment can be
+tuned without code edits.
+"""
+
+import os
+
+from functools import wraps
+
+from opster import Dispatcher
+
+SIZE_SUFFIXES = dict(K=1 << 10, M=1 << 20, G=1 << 30, T=1 << 40)
+
+
+def parse_size(value):
+    """Returns number of bytes in size like 4096, 512M or 4G, 0 when not set"""
+    value = (value or '').strip().upper().rstrip('B')
+    if not value:
+        return 0
+    if value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+OPTIONS = [
+    ('j', 'jobs', 0, 'number of worker processes, 0 is one per CPU'),
+    ('', 'batch-size', 0, 'number of items per worker task, 0 is tool default'),
+    ('', 'cache-size', 0, 'number of entries of in-memory caches, 0 is tool default'),
+    ('', 'max-memory', parse_size, 'memory limit of every process, e.g. 512M or 4G'),
+    ('', 'profile', '', 'dump cProfile stats of main and worker processes to this directory'),
+]
+# Names of keyword arguments middleware takes off commands
+NAMES = [name.replace('-', '_') for _, name, _, _ in OPTIONS]
+
+
+class Runtime(object):
+    __doc__ = """Settings of current process, zero means tool's own default"""
+    def __init__(self):
+        self.jobs = 0
+        self.batch_size = 0
+        self.cache_size = 0
+        self.max_memory = 0
+        self.profile = ''
+
+    def configure(self, jobs=0, batch_size=0, cache_size=0, max_memory=0, profile=''):
+        """Sets options, memory limit and profiling take effect immediately"""
+        self.jobs, self.batch_size, self.cache_size = jobs, batch_size, cache_size
+        self.max_memory, self.profile = max_memory, profile
+        if max_memory:
+            # Inherited by worker processes, allocations above it raise
+            # MemoryError instead of waking up the OOM killer. Data segment
+            # rather than address space is limited: every thread reserves
+            # (but doesn't use) a 64M malloc arena and its stack
+            import resource
+            resource.setrlimit(resource.RLIMIT_DATA, (max_memory, resource.getrlimit(resource.RLIMIT_DATA)[1]))
+        if profile:
+            from profiling import enable_profiling
+            if not os.path.isdir(profile):
+                os.makedirs(profile)
+            enable_profiling(profile)
+        return self
+
+    @property
+    def workers(self):
+        """Number of worker processes"""
+        from multiprocessing import cpu_count
+        return self.jobs or cpu_count()
+
+    def batch(self, default):
+        return self.batch_size or default
+
+    def cache(self, default):
+        return self.cache_size or default
+
+    def pool(self, processes=None, initializer=None, initargs=()):
+        """Returns multiprocessing Pool of ``processes`` or ``workers`` processes"""
+        from multiprocessing import Pool
+        return Pool(processes or self.workers, initializer=_worker_init, initargs=(initializer, initargs))
+
+
+def _worker_init(initializer, initargs):
+    from profiling import worker_init
+    worker_init()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+# Settings of current process
+RUNTIME = Runtime()
+
+
+def middleware(func):
+    """Takes runtime options off command's arguments and applies them"""
+    @wraps(func)
+    def inner(*args, **kwargs):
+        RUNTIME.configure(**dict((name, kwargs.pop(name)) for name in NAMES if name in kwargs))
+        if RUNTIME.profile:
+            from profiling import profile_main
+            return profile_main(func, *args, **kwargs)
+        return func(*args, **kwargs)
+    return inner
+
+
+def dispatcher(cmdtable=None):
+    """Returns Dispatcher whose commands accept runtime options, ``cmdtable`` may hold ``LazyCommand`` entries"""
+    return Dispatcher(cmdtable, globaloptions=list(OPTIONS), middleware=middleware)
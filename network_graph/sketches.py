@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed size mergeable sketches for approximate graph aggregation:
+count-min sketch for edge weights, HyperLogLog for number of distinct nodes
+and top-K tracker of heaviest edges on top of count-min.
+"""
+
+import struct
+
+from array import array
+from hashlib import md5
+from heapq import heapify, heappush, heapreplace
+
+
+def hash64(key):
+    """Returns pair of independent 64-bit hashes of a string"""
+    return struct.unpack('<QQ', md5(key).digest())
+
+
+class CountMinSketch(object):
+    __doc__ = """Count-min sketch of ``depth`` rows by ``width`` counters"""
+    def __init__(self, width=1 << 14, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = array('d', [0]) * (width * depth)
+
+    def _cells(self, key):
+        # Kirsch-Mitzenmacher: row hashes are derived from two base hashes
+        h1, h2 = hash64(key)
+        return [row * self.width + (h1 + row * h2) % self.width for row in xrange(self.depth)]
+
+    def add(self, key, count=1):
+        """Adds ``count`` to key and returns its new estimate"""
+        table = self.table
+        estimate = None
+        for cell in self._cells(key):
+            table[cell] += count
+            if estimate is None or table[cell] < estimate:
+                estimate = table[cell]
+        return estimate
+
+    def estimate(self, key):
+        """Returns estimate of key's count, never less than the real one"""
+        table = self.table
+        return min(table[cell] for cell in self._cells(key))
+
+    def merge(self, other):
+        """Adds counts of sketch of the same shape"""
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("Can't merge sketches of different shapes")
+        self.table = array('d', map(sum, zip(self.table, other.table)))
+        return self
+
+
+class HyperLogLog(object):
+    __doc__ = """HyperLogLog cardinality estimator with 2 ** ``precision`` registers"""
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, key):
+        x = hash64(key)[0]
+        bits = 64 - self.precision
+        idx = x >> bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def count(self):
+        """Returns estimated number of distinct keys added"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more precise for small cardinalities
+            from math import log
+            return m * log(float(m) / zeros)
+        return estimate
+
+    def merge(self, other):
+        """Merges estimator of the same precision"""
+        if self.precision != other.precision:
+            raise ValueError("Can't merge estimators of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+
+class TopK(object):
+    __doc__ = """
+    Tracks ``k`` keys with the largest count-min estimates. Min-heap has one
+    (estimate, key) entry per candidate, estimates only grow, so entry may
+    be stale (too low) and is refreshed when it gets to the top.
+    """
+    def __init__(self, k=1000):
+        self.k = k
+        self.candidates = dict()
+        self.heap = list()
+
+    def _smallest(self):
+        """Returns heap's top entry after refreshing stale ones"""
+        heap, candidates = self.heap, self.candidates
+        while heap[0][0] != candidates[heap[0][1]]:
+            heapreplace(heap, (candidates[heap[0][1]], heap[0][1]))
+        return heap[0]
+
+    def offer(self, key, estimate):
+        candidates = self.candidates
+        if key in candidates:
+            candidates[key] = estimate
+        elif len(candidates) < self.k:
+            candidates[key] = estimate
+            heappush(self.heap, (estimate, key))
+        # Top of heap is a lower bound of the smallest estimate
+        elif estimate > self.heap[0][0]:
+            smallest, smallest_key = self._smallest()
+            if estimate > smallest:
+                del candidates[smallest_key]
+                candidates[key] = estimate
+                heapreplace(self.heap, (estimate, key))
+
+    def merge(self, other, sketch):
+        """Merges candidates re-estimating them with (already merged) sketch"""
+        self.candidates.update(other.candidates)
+        estimates = sorted(((sketch.estimate(key), key) for key in self.candidates), reverse=True)[:self.k]
+        self.candidates = dict((key, estimate) for estimate, key in estimates)
+        self.heap = estimates
+        heapify(self.heap)
+        return self
+
+    def items(self):
+        """Returns (key, estimate) pairs, heaviest first"""
+        return sorted(self.candidates.iteritems(), key=lambda item: item[1], reverse=True)
+
+
+class EdgeSketch(object):
+    __doc__ = """Approximate replacement of exact edge weights and node set"""
+    def __init__(self, k=1000, width=1 << 14, depth=4, precision=14):
+        self.weights = CountMinSketch(width, depth)
+        self.nodes = HyperLogLog(precision)
+        self.top = TopK(k)
+
+    def add(self, ip_src, ip_dst, weight=1):
+        key = ip_src + ' ' + ip_dst
+        self.top.offer(key, self.weights.add(key, weight))
+        self.nodes.add(ip_src)
+        self.nodes.add(ip_dst)
+
+    def merge(self, other):
+        self.weights.merge(other.weights)
+        self.nodes.merge(other.nodes)
+        self.top.merge(other.top, self.weights)
+        return self
+
+    def edges(self):
+        """Returns (ip_src, ip_dst, estimated weight) of the heaviest edges"""
+        return [tuple(key.split(' ', 1)) + (weight,) for key, weight in self.top.items()]
@@ -0,0 +1,60 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+import external
+from external import ExternalAggregator, add_vectors
+
+
+class ExternalAggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rnd = random.Random(0)
+        self.items = [(('10.0.0.{0}'.format(rnd.randint(0, 50)), 'x'), rnd.randint(1, 5)) for _ in xrange(5000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def expected(self):
+        counts = Counter()
+        for key, value in self.items:
+            counts[key] += value
+        return sorted(counts.items())
+
+    def test_spilled_runs_are_merged_in_key_order(self):
+        # Budget of a few entries
+        with ExternalAggregator(budget=2000, directory=self.directory) as aggregator:
+            aggregator.update(self.items)
+            self.assertGreater(aggregator.spills, 10)
+            self.assertEqual(list(aggregator.items()), self.expected())
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_runs_are_compacted(self):
+        self.addCleanup(setattr, external, 'MAX_RUNS', external.MAX_RUNS)
+        external.MAX_RUNS = 3
+        with ExternalAggregator(budget=2000, directory=self.directory) as aggregator:
+            aggregator.update(self.items)
+            self.assertLess(len(aggregator.runs), 3)
+            self.assertEqual(list(aggregator.items()), self.expected())
+
+    def test_in_memory_without_spills(self):
+        with ExternalAggregator(combine=add_vectors, budget=1 << 20, directory=self.directory) as aggregator:
+            aggregator.update([('b', (1, 2)), ('a', (1, 0)), ('b', (3, 4))])
+            self.assertEqual(aggregator.spills, 0)
+            self.assertEqual(list(aggregator.items()), [('a', (1, 0)), ('b', (4, 6))])
+
+    def test_runs_are_removed_on_error(self):
+        try:
+            with ExternalAggregator(budget=2000, directory=self.directory) as aggregator:
+                aggregator.update(self.items)
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
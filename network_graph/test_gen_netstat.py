@@ -0,0 +1,41 @@
+import random
+import unittest
+from collections import Counter
+
+from gen_netstat import address, netstat_lines
+
+
+class NetstatLinesTest(unittest.TestCase):
+    def connections(self, hosts=200, seed=0):
+        """Returns (host, peer) address pairs of one snapshot of every host"""
+        rnd = random.Random(seed)
+        popularity = range(hosts)
+        rnd.shuffle(popularity)
+        pairs = list()
+        for host in xrange(hosts):
+            for line in netstat_lines(host, popularity, 20, 0, False, rnd):
+                fields = line.split()
+                if fields and fields[0] == 'tcp' and fields[-1] != 'LISTEN':
+                    pairs.append((fields[3].rsplit(':', 1)[0], fields[4].rsplit(':', 1)[0]))
+        return popularity, pairs
+
+    def test_no_connections_to_self(self):
+        _, pairs = self.connections()
+        self.assertTrue(pairs)
+        self.assertFalse([pair for pair in pairs if pair[0] == pair[1]])
+
+    def test_most_popular_host_is_hub(self):
+        popularity, pairs = self.connections()
+        fan_in = Counter(peer for _, peer in pairs)
+        hub, _ = fan_in.most_common(1)[0]
+        self.assertEqual(hub, address(popularity[0]))
+        # Hub is reached from most hosts, not only from its neighbours
+        self.assertGreater(len(set(host for host, peer in pairs if peer == hub)), 100)
+
+    def test_single_host(self):
+        lines = list(netstat_lines(0, [0], 5, 0, False, random.Random(0)))
+        self.assertGreater(len(lines), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+
+from graph_analytics import Graph, connected_components, degrees, pagerank, top_talkers
+
+
+def graph(n, edges):
+    """Returns graph of ``n`` nodes from (source, target) pairs of unit weight"""
+    ids = np.array([str(idx) for idx in xrange(n)], dtype=object)
+    sources, targets = (np.array(column, dtype=np.int64) for column in zip(*edges))
+    return Graph(ids, ids, np.array([''] * n, dtype=object), sources, targets, np.ones(len(edges)))
+
+
+def star(n=5):
+    """Node 0 talking to every other node both ways"""
+    return [(leaf, 0) for leaf in xrange(1, n)] + [(0, leaf) for leaf in xrange(1, n)]
+
+
+class GraphAnalyticsTest(unittest.TestCase):
+    def test_connected_components(self):
+        # Star, chain pointing against label order and isolated node
+        labels = connected_components(graph(10, star() + [(8, 7), (7, 6), (6, 5)]))
+        np.testing.assert_array_equal(labels, [0, 0, 0, 0, 0, 5, 5, 5, 5, 9])
+
+    def test_pagerank_of_star(self):
+        rank = pagerank(graph(5, star()))
+        # r0 = 0.15 / 5 + 0.85 * 4 * r1, r1 = 0.15 / 5 + 0.85 * r0 / 4
+        np.testing.assert_allclose(rank, [0.132 / 0.2775] + [0.03 + 0.2125 * 0.132 / 0.2775] * 4, rtol=1e-6)
+
+    def test_pagerank_ranks_center_first(self):
+        rank = pagerank(graph(10, star() + [(8, 7), (7, 6), (6, 5)]))
+        self.assertAlmostEqual(rank.sum(), 1)
+        self.assertEqual(np.argmax(rank), 0)
+        # Dangling end of chain collects rank from it
+        self.assertEqual(np.argmax(rank[5:9]), 0)
+
+    def test_degrees_and_top_talkers(self):
+        g = graph(6, star() + [(5, 0)])
+        out_degree, in_degree = degrees(g)
+        np.testing.assert_array_equal(out_degree, [4, 1, 1, 1, 1, 1])
+        np.testing.assert_array_equal(in_degree, [5, 1, 1, 1, 1, 0])
+        top, total = top_talkers(g, k=2)
+        self.assertEqual(top[0], 0)
+        self.assertEqual(total[0], 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import opster
+from opster import CompletionCache
+
+
+def hello(name=None):
+    pass
+
+
+class CompletionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.script = os.path.join(self.directory, 'script.py')
+        with open(self.script, 'w') as fd:
+            fd.write('pass\n')
+        self.addCleanup(setattr, sys, 'argv', sys.argv)
+        sys.argv = [self.script]
+        self.calls = []
+
+    def completer(self, current):
+        self.calls.append(current)
+        return [current + 'a', current + 'b']
+
+    def reopen(self, cache, **kwargs):
+        cache.save()
+        return CompletionCache(cache.path, **kwargs)
+
+    def test_result_is_reused_between_runs(self):
+        cache = CompletionCache.for_script()
+        self.assertEqual(cache.complete(('hello', '--name', 'x'), self.completer, 'x'), ['xa', 'xb'])
+        cache = self.reopen(cache)
+        self.assertEqual(cache.complete(('hello', '--name', 'x'), self.completer, 'x'), ['xa', 'xb'])
+        self.assertEqual(self.calls, ['x'])
+        cache.complete(('hello', '--name', 'y'), self.completer, 'y')
+        self.assertEqual(self.calls, ['x', 'y'])
+
+    def test_result_depends_on_current_directory(self):
+        cache = CompletionCache.for_script()
+        self.addCleanup(os.chdir, os.getcwd())
+        cache.complete(('hello', '--name', 'x'), self.completer, 'x')
+        os.chdir(self.directory)
+        cache.complete(('hello', '--name', 'x'), self.completer, 'x')
+        self.assertEqual(self.calls, ['x', 'x'])
+
+    def test_result_expires(self):
+        self.addCleanup(setattr, opster.time, 'time', opster.time.time)
+        now = opster.time.time()
+        opster.time.time = lambda: now
+        cache = CompletionCache.for_script(self.script)
+        cache.complete(('hello', '--name', 'x'), self.completer, 'x')
+        opster.time.time = lambda: now + cache.ttl
+        cache = self.reopen(cache)
+        cache.complete(('hello', '--name', 'x'), self.completer, 'x')
+        self.assertEqual(self.calls, ['x', 'x'])
+        self.assertEqual(len(cache.data['results']), 1)
+
+    def test_index_is_rebuilt_when_script_changes(self):
+        cmdtable = {'^hello': (hello, [('n', 'name', '', 'name', self.completer)], '')}
+        cache = CompletionCache.for_script()
+        index = cache.index(cmdtable)
+        self.assertEqual(index['commands'], ['hello'])
+        self.assertEqual(index['options']['^hello'], [('-n', '--name', True)])
+        cache = self.reopen(cache)
+        # Unchanged script, table isn't looked at
+        self.assertEqual(cache.index({})['commands'], ['hello'])
+        self.assertFalse(cache.dirty)
+        with open(self.script, 'a') as fd:
+            fd.write('pass\n')
+        self.assertEqual(cache.index({})['commands'], [])
+        self.assertTrue(cache.dirty)
+
+
+if __name__ == '__main__':
+    unittest.main()
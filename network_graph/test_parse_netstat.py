@@ -0,0 +1,411 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from contextlib import closing
+
+import parse_netstat
+
+NETSTAT_HEADER = '''Active Internet connections (servers and established)
+Proto Recv-Q Send-Q Local Address           Foreign Address         State
+'''
+
+
+def netstat(connections):
+    """Returns netstat -an output of (local ip, remote ip, count) connections"""
+    lines = [NETSTAT_HEADER]
+    for local, remote, count in connections:
+        for port in xrange(count):
+            lines.append('tcp        0      0 {0}:{1:<15} {2}:443 ESTABLISHED\n'.format(local, 40000 + port, remote))
+    return ''.join(lines)
+
+
+def netstat_text(count):
+    return netstat([('172.16.0.1', '172.16.0.2', count)])
+
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as fd:
+            fd.write(text)
+        return self.path(name)
+
+
+class ParserTest(TempDirTest):
+    def connections(self, text):
+        netstat = parse_netstat.parse_input(self.write('input', text))
+        return [(c.ip_src, c.port_src, c.ip_dst, c.port_dst, c.rx_q, c.tx_q, c.timestamp) for c in netstat.connections]
+
+    def test_netstat_linux_and_freebsd(self):
+        self.assertEqual(self.connections(NETSTAT_HEADER +
+                                          'tcp        1      2 172.16.0.1:22           172.16.0.2:51000        ESTABLISHED\n'
+                                          'tcp6       0      0 2001:db8::1:443         2001:db8::2:51000       ESTABLISHED\n'
+                                          'tcp        0      0 0.0.0.0:22              0.0.0.0:*               LISTEN\n'
+                                          'tcp        0      0 127.0.0.1:5432          127.0.0.1:40000         ESTABLISHED\n'),
+                         [('172.16.0.1', '22', '172.16.0.2', '51000', 1, 2, 0),
+                          ('2001:db8::1', '443', '2001:db8::2', '51000', 0, 0, 0)])
+        self.assertEqual(self.connections(NETSTAT_HEADER +
+                                          'tcp4       0      0  172.16.0.1.22          172.16.0.2.51000       ESTABLISHED\n'),
+                         [('172.16.0.1', '22', '172.16.0.2', '51000', 0, 0, 0)])
+
+    def test_proc_net_tcp(self):
+        self.assertEqual(self.connections(
+            '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n'
+            '   0: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 1\n'
+            '   1: 0100A8C0:0016 0200A8C0:C738 01 00000002:00000001 00:00000000 00000000     0        0 2\n'
+            '  sl  local_address                         remote_address                        st tx_queue rx_queue\n'
+            '   0: B80D0120000000000000000001000000:01BB B80D0120000000000000000002000000:C738 01 00000000:00000000\n'),
+            [('192.168.0.1', '22', '192.168.0.2', '51000', 1, 2, 0),
+             ('2001:db8::1', '443', '2001:db8::2', '51000', 0, 0, 0)])
+
+    def test_ss(self):
+        self.assertEqual(self.connections(
+            'State      Recv-Q Send-Q Local Address:Port               Peer Address:Port\n'
+            'LISTEN     0      128    *:22                            *:*\n'
+            'ESTAB      3      4      172.16.0.1%eth0:22              172.16.0.2:51000\n'
+            'ESTAB      0      0      [2001:db8::1]:443               [2001:db8::2]:51000\n'),
+            [('172.16.0.1', '22', '172.16.0.2', '51000', 3, 4, 0),
+             ('2001:db8::1', '443', '2001:db8::2', '51000', 0, 0, 0)])
+
+    def test_snapshots(self):
+        netstat = parse_netstat.parse_input(self.write('input', '100\n' + netstat_text(1) + '200\n' + netstat_text(2)))
+        self.assertEqual(netstat.snapshots, 2)
+        self.assertEqual([c.timestamp for c in netstat.connections], [100, 200, 200])
+        # Repeated header without date line starts snapshot of the same time
+        netstat = parse_netstat.parse_input(self.write('input', netstat_text(1) + netstat_text(1)), timestamp=7)
+        self.assertEqual(netstat.snapshots, 2)
+        self.assertEqual([c.timestamp for c in netstat.connections], [7, 7])
+
+    def test_unknown_format(self):
+        netstat = parse_netstat.parse_input(self.write('input', 'hello\n'))
+        self.assertEqual((netstat.snapshots, netstat.connections), (0, []))
+        # Failure to read is told apart from unknown format
+        self.assertIsNone(parse_netstat.parse_input(self.write('input', '\x1f\x8b' + 'x' * 100)))
+
+
+def gzip_compress(data):
+    from gzip import GzipFile
+    from StringIO import StringIO
+    out = StringIO()
+    with GzipFile(fileobj=out, mode='wb') as fd:
+        fd.write(data)
+    return out.getvalue()
+
+
+def xz_compress(data):
+    try:
+        from lzma import compress
+    except ImportError:
+        from backports.lzma import compress
+    return compress(data)
+
+
+def has_module(*names):
+    for name in names:
+        try:
+            __import__(name)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+class DecompressionTest(TempDirTest):
+    def setUp(self):
+        super(DecompressionTest, self).setUp()
+        self.snapshots = ['{0}\n'.format(100 * idx) + netstat_text(idx) for idx in xrange(1, 4)]
+
+    def check(self, compress):
+        from hashlib import sha1
+        raw = ''.join(compress(snapshot) for snapshot in self.snapshots)
+        path = self.write('input', raw)
+        # Small reads put stream ends on and off chunk boundaries
+        for read_size in (1, 7, len(raw)):
+            self.patch('READ_SIZE', read_size)
+            digest = sha1()
+            self.assertEqual(''.join(parse_netstat.open_input(path, digest=digest)), ''.join(self.snapshots))
+            self.assertEqual(digest.hexdigest(), sha1(raw).hexdigest())
+
+    def patch(self, name, value):
+        self.addCleanup(setattr, parse_netstat, name, getattr(parse_netstat, name))
+        setattr(parse_netstat, name, value)
+
+    def test_plain(self):
+        self.check(lambda data: data)
+
+    def test_concatenated_gzip(self):
+        self.check(gzip_compress)
+
+    def test_concatenated_bz2(self):
+        from bz2 import compress
+        self.check(compress)
+
+    @unittest.skipUnless(has_module('lzma', 'backports.lzma'), 'lzma is not installed')
+    def test_concatenated_xz(self):
+        self.check(xz_compress)
+
+    @unittest.skipUnless(has_module('zstandard'), 'zstandard is not installed')
+    def test_concatenated_zstd(self):
+        from zstandard import ZstdCompressor
+        self.check(ZstdCompressor().compress)
+
+    def test_truncated_stream_raises(self):
+        from bz2 import compress
+        for raw in (gzip_compress(self.snapshots[0]), compress(self.snapshots[0])):
+            path = self.write('input', raw + raw[:len(raw) // 2])
+            self.assertRaises(IOError, list, parse_netstat.open_input(path))
+
+    def test_compressed_file_is_parsed(self):
+        netstat = parse_netstat.parse_input(self.write('input.gz', gzip_compress(netstat_text(2))))
+        self.assertEqual(len(netstat.connections), 2)
+
+
+class DcTest(TempDirTest):
+    def load(self, networks):
+        parse_netstat.DC.clear()
+        self.addCleanup(parse_netstat.DC.clear)
+        self.assertTrue(parse_netstat.cache_dc(self.write('networks.txt', networks)))
+
+    def test_most_specific_network_wins(self):
+        self.load('BIG 10.0.0.0/8\nSMALL 10.0.0.0/24\nMID 10.0.0.0/16\nOTHER 10.1.2.0/24\n')
+        self.assertEqual(parse_netstat.get_dc('10.0.0.5'), 'SMALL')
+        self.assertEqual(parse_netstat.get_dc('10.0.1.5'), 'MID')
+        self.assertEqual(parse_netstat.get_dc('10.1.2.3'), 'OTHER')
+        self.assertEqual(parse_netstat.get_dc('10.2.0.1'), 'BIG')
+        self.assertEqual(parse_netstat.get_dc('11.0.0.1'), '')
+        self.assertEqual(parse_netstat.get_dc('9.255.255.255'), '')
+
+    def test_address_after_nested_networks(self):
+        # Siblings inside BIG precede address, lookup still finds BIG
+        self.load('BIG 10.0.0.0/8\n' + ''.join('S{0} 10.0.{0}.0/24\n'.format(idx) for idx in xrange(100)))
+        self.assertEqual(parse_netstat.get_dc('10.0.200.1'), 'BIG')
+        self.assertEqual(parse_netstat.get_dc('10.0.42.1'), 'S42')
+        self.assertEqual(parse_netstat.DC_PARENTS.count(0), 100)
+
+    def test_edges_of_networks(self):
+        self.load('A 0.0.0.0/32\nB 192.168.0.0/30\n')
+        self.assertEqual(parse_netstat.get_dc('0.0.0.0'), 'A')
+        self.assertEqual(parse_netstat.get_dc('192.168.0.3'), 'B')
+        self.assertEqual(parse_netstat.get_dc('192.168.0.4'), '')
+
+
+class IngestTest(TempDirTest):
+    def setUp(self):
+        super(IngestTest, self).setUp()
+        self.database = self.path('graph.db')
+
+    def ingest(self, *args):
+        from StringIO import StringIO
+        # Run statistics are printed to stderr
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            parse_netstat.main.command(['-o', self.database, '-c', os.devnull, '--no-resolve', '-j', '1'] + list(args))
+            return sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+            parse_netstat.STATS.reset()
+
+    def rows(self, query):
+        conn = sqlite3.connect(self.database)
+        try:
+            return sorted(conn.execute(query).fetchall())
+        finally:
+            conn.close()
+
+
+class ApproximateTest(IngestTest):
+    def test_approximate_runs_replace_their_table_only(self):
+        a = self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 3), ('172.16.0.1', '172.16.0.3', 1)]))
+        self.ingest(a)
+        exact = self.rows('select * from edges')
+        self.assertEqual(len(exact), 2)
+        for _ in xrange(2):
+            self.ingest('--approximate', a)
+            self.assertEqual(self.rows('select * from approx_edges'),
+                             [(u'172.16.0.1', u'172.16.0.2', 3.0), (u'172.16.0.1', u'172.16.0.3', 1.0)])
+        self.assertEqual(self.rows('select * from edges'), exact)
+        self.assertEqual(len(self.rows('select * from files')), 1)
+        out = self.path('approx.edges')
+        self.ingest('--approximate', '--export', out, a)
+        with open(out) as lines:
+            self.assertEqual(len(lines.readlines()), 2)
+
+
+class ManifestTest(IngestTest):
+    def test_failed_write_is_not_committed(self):
+        a = self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 2)]))
+
+        def broken(c, windows):
+            raise IOError('disk full')
+        add_windows = parse_netstat.add_windows
+        parse_netstat.add_windows = broken
+        try:
+            self.ingest(a)
+        finally:
+            parse_netstat.add_windows = add_windows
+        self.assertEqual(self.rows('select * from files'), [])
+        self.assertEqual(self.rows('select * from edges'), [])
+        # File is retried by the next run
+        self.ingest(a)
+        self.assertEqual(self.rows('select * from edges'), [(u'172.16.0.1', u'172.16.0.2', 2.0)])
+        self.assertEqual(len(self.rows('select * from edge_windows')), 1)
+
+    def test_unrecognized_file_is_recorded(self):
+        junk = self.write('junk.txt', 'not a netstat output\n')
+        self.ingest(junk)
+        self.assertEqual([row[0] for row in self.rows('select path from files')], [junk])
+        self.assertEqual(parse_netstat.pending_files([junk], filename=self.database), [])
+
+    def test_unreadable_file_is_retried_and_keeps_contribution(self):
+        a = self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 3)]))
+        self.ingest(a)
+        files = self.rows('select * from files')
+        # Corrupt gzip, e.g. file being replaced while read
+        self.write('a.netstat', gzip_compress(netstat_text(5))[:-20] + 'x' * 20)
+        self.ingest(a)
+        self.assertEqual(self.rows('select * from files'), files)
+        self.assertEqual(self.rows('select * from edges'), [(u'172.16.0.1', u'172.16.0.2', 3.0)])
+        self.assertEqual(parse_netstat.pending_files([a], filename=self.database), [a])
+
+    def test_changed_file_replaces_its_contribution(self):
+        a = self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 3)]))
+        b = self.write('b.netstat', netstat([('172.16.0.1', '172.16.0.2', 1)]))
+        self.ingest(a, b)
+        self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 1), ('172.16.0.1', '172.16.0.3', 2)]))
+        self.ingest(a, b)
+        self.assertEqual(self.rows('select * from edges'),
+                         [(u'172.16.0.1', u'172.16.0.2', 2.0), (u'172.16.0.1', u'172.16.0.3', 2.0)])
+        self.assertEqual(self.rows('select * from subnet_edges'), [(u'172.16.0.0/24', u'172.16.0.0/24', 4.0)])
+
+    def test_force_reprocesses_unchanged_files(self):
+        started = 1700000030
+        a = self.write('a.netstat', '{0}\n'.format(started) + netstat([('172.16.0.1', '172.16.0.2', 2)]))
+        self.ingest('-w', '60', a)
+        self.ingest('-w', '3600', a)
+        self.assertEqual(self.rows('select window from edge_windows'), [(started - started % 60,)])
+        self.ingest('--force', '-w', '3600', a)
+        self.assertEqual(self.rows('select window, weight from edge_windows'), [(started - started % 3600, 2.0)])
+        self.assertEqual(self.rows('select * from edges'), [(u'172.16.0.1', u'172.16.0.2', 2.0)])
+
+    def test_manifest_without_windows_is_migrated(self):
+        a = self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 1)]))
+        # Database written before time windows, a.netstat had 3 connections then
+        conn = sqlite3.connect(self.database)
+        conn.execute('create table edges (source string, target string, weight real)')
+        conn.execute('create unique index edges_idx on edges (source, target)')
+        conn.execute('create table files (path string primary key, size integer, mtime real, digest string)')
+        conn.execute('create table file_edges (path string, source string, target string, weight real)')
+        conn.execute('create index file_edges_path_idx on file_edges (path)')
+        conn.execute("insert into edges values ('172.16.0.1', '172.16.0.2', 3)")
+        conn.execute("insert into files values (?, 1, 0, 'old')", (a,))
+        conn.execute("insert into file_edges values (?, '172.16.0.1', '172.16.0.2', 3)", (a,))
+        conn.commit()
+        conn.close()
+        self.ingest(a)
+        self.assertEqual(self.rows('select * from edges'), [(u'172.16.0.1', u'172.16.0.2', 1.0)])
+        self.assertEqual(self.rows('select source, target, weight from edge_windows'),
+                         [(u'172.16.0.1', u'172.16.0.2', 1.0)])
+        self.assertEqual(self.rows('select source, target, weight from file_edges'),
+                         [(u'172.16.0.1', u'172.16.0.2', 1.0)])
+
+
+class ExportTest(IngestTest):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.ingest(self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 3), ('172.16.0.1', '172.16.0.3', 1)])))
+
+    def export(self, name):
+        self.assertTrue(parse_netstat.export_graph(self.database, self.path(name)))
+        return self.path(name)
+
+    def test_gdf(self):
+        with open(self.export('graph.gdf')) as lines:
+            lines = lines.read().splitlines()
+        self.assertEqual(lines[0], 'nodedef>name VARCHAR,label VARCHAR,dc VARCHAR')
+        self.assertEqual(sorted(lines[1:4]), ["'172.16.0.{0}','172.16.0.{0}',''".format(idx) for idx in (1, 2, 3)])
+        self.assertEqual(lines[4], 'edgedef>node1 VARCHAR,node2 VARCHAR,weight DOUBLE')
+        self.assertEqual(sorted(lines[5:]), ["'172.16.0.1','172.16.0.2',3.0", "'172.16.0.1','172.16.0.3',1.0"])
+
+    def test_gexf(self):
+        import gzip
+        from xml.etree import ElementTree
+        ns = '{http://www.gexf.net/1.2draft}'
+        for name, opener in (('graph.gexf', open), ('graph.gexf.gz', gzip.open)):
+            with closing(opener(self.export(name))) as fd:
+                graph = ElementTree.parse(fd).getroot().find(ns + 'graph')
+            nodes = graph.findall('{0}nodes/{0}node'.format(ns))
+            self.assertEqual(sorted(node.get('id') for node in nodes), ['172.16.0.{0}'.format(idx) for idx in (1, 2, 3)])
+            edges = graph.findall('{0}edges/{0}edge'.format(ns))
+            self.assertEqual(sorted((edge.get('source'), edge.get('target'), edge.get('weight')) for edge in edges),
+                             [('172.16.0.1', '172.16.0.2', '3.0'), ('172.16.0.1', '172.16.0.3', '1.0')])
+            self.assertEqual(len(set(edge.get('id') for edge in edges)), 2)
+
+    def test_values_are_quoted(self):
+        from StringIO import StringIO
+        from xml.etree import ElementTree
+        label = u"it's <a&b> \"\u0444\""
+        conn = sqlite3.connect(':memory:')
+        rows = lambda: (conn.execute('select ?, ?, null', ('x', label)), conn.execute('select ?, ?, 1.0', ('x', 'x')))
+        out = StringIO()
+        parse_netstat.export_gdf(out, *rows())
+        self.assertIn(u"'x','it\\'s <a&b> \"\u0444\"',''\n".encode('utf-8'), out.getvalue())
+        out = StringIO()
+        parse_netstat.export_gexf(out, *rows())
+        node = ElementTree.fromstring(out.getvalue()).find('.//{http://www.gexf.net/1.2draft}node')
+        self.assertEqual(node.get('label'), label)
+
+
+class RollupTest(IngestTest):
+    def test_rollups_created_on_filled_database_are_seeded(self):
+        a = self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 3), ('172.16.0.1', '172.16.1.3', 1)]))
+        self.ingest(a)
+        expected = [self.rows('select * from {0}'.format(table)) for table in ('dc_edges', 'subnet_edges')]
+        self.assertEqual(expected[1], [(u'172.16.0.0/24', u'172.16.0.0/24', 3.0),
+                                       (u'172.16.0.0/24', u'172.16.1.0/24', 1.0)])
+        # Database filled before rollups were introduced
+        conn = sqlite3.connect(self.database)
+        conn.execute('drop table dc_edges')
+        conn.execute('drop table subnet_edges')
+        conn.commit()
+        conn.close()
+        self.ingest(a)
+        self.assertEqual([self.rows('select * from {0}'.format(table)) for table in ('dc_edges', 'subnet_edges')],
+                         expected)
+
+
+class MaxMemoryTest(IngestTest):
+    def test_documented_limit(self):
+        import subprocess
+        a = self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 2)]))
+        # Limit stays with the process, so it runs in a separate one
+        subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parse_netstat.py'),
+                               '-o', self.database, '-c', os.devnull, '--no-resolve', '--max-memory', '512M', a],
+                              stderr=open(os.devnull, 'w'))
+        self.assertEqual(self.rows('select * from edges'), [(u'172.16.0.1', u'172.16.0.2', 2.0)])
+
+
+class StartupProfileTest(IngestTest):
+    def test_flag_is_taken_off_command_line_of_command_only(self):
+        argv = sys.argv[:]
+        a = self.write('a.netstat', netstat([('172.16.0.1', '172.16.0.2', 1)]))
+        report = self.ingest('--startup-profile', a)
+        self.assertIn('slowest imports', report)
+        self.assertEqual(sys.argv, argv)
+        self.assertEqual(len(self.rows('select * from edges')), 1)
+        # Report is written once per flag
+        self.assertNotIn('slowest imports', self.ingest(a))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import pickle
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import profiling
+from profiling import Stats, profiled
+from runtime import RUNTIME
+
+
+@profiled
+def square(value):
+    return value * value
+
+
+class StatsTest(unittest.TestCase):
+    def stats(self, wall, files, depth):
+        stats = Stats()
+        stats.add('parse', wall, wall / 2)
+        stats.count('files', files)
+        stats.gauge('backlog', depth)
+        return stats
+
+    def test_merge_and_report(self):
+        # Worker stats travel back pickled
+        merged = self.stats(1.0, 3, 4).merge(pickle.loads(pickle.dumps(self.stats(2.0, 5, 2))))
+        self.assertEqual(merged.stages, {'parse': [3.0, 1.5, 2]})
+        self.assertEqual(merged.counters, {'files': 8})
+        summary = merged.summary(wall=4.0, workers=2)
+        self.assertEqual(summary['rates'], {'files/s': 2.0})
+        self.assertEqual(summary['gauges'], {'backlog': {'max': 4, 'mean': 3.0}})
+        report = merged.report(wall=4.0, workers=2)
+        self.assertIn('parse             3.000      1.500          2\n', report)
+        self.assertIn('files: 8 (2.0)\n', report)
+        self.assertIn('backlog: max 4, mean 3.0\n', report)
+
+    def test_nested_stages_are_exclusive(self):
+        stats = Stats()
+        with stats.stage('outer'):
+            with stats.stage('inner'):
+                sum(xrange(100000))
+        self.assertEqual(stats.stages['outer'][2], 1)
+        self.assertLess(stats.stages['outer'][0], stats.stages['inner'][0])
+
+    def test_reset(self):
+        stats = self.stats(1.0, 3, 4)
+        copy = stats.reset()
+        self.assertEqual(copy.counters, {'files': 3})
+        self.assertEqual((stats.stages, stats.counters, stats.gauges), ({}, {}, {}))
+
+
+class ProfiledTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(setattr, profiling, 'PROFILE_DIR', profiling.PROFILE_DIR)
+        profiling.enable_profiling(self.directory)
+
+    def test_worker_stats_are_dumped_once_on_exit(self):
+        pool = RUNTIME.pool(1)
+        try:
+            self.assertEqual(pool.map(square, range(20), chunksize=1), [value * value for value in xrange(20)])
+            self.assertEqual(os.listdir(self.directory), [])
+        finally:
+            pool.close()
+            pool.join()
+        dumps = os.listdir(self.directory)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].startswith('worker-'))
+        calls = [stat[1] for (_, _, name), stat in pstats.Stats(os.path.join(self.directory, dumps[0])).stats.items()
+                 if name == 'square']
+        self.assertEqual(calls, [20])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import resource
+import shutil
+import tempfile
+import unittest
+
+import profiling
+import runtime
+from runtime import RUNTIME, dispatcher, parse_size
+
+
+class ParseSizeTest(unittest.TestCase):
+    def test_suffixes(self):
+        self.assertEqual(parse_size('4096'), 4096)
+        self.assertEqual(parse_size('4K'), 4 << 10)
+        self.assertEqual(parse_size('512M'), 512 << 20)
+        self.assertEqual(parse_size('512mb'), 512 << 20)
+        self.assertEqual(parse_size(' 1.5G '), 3 << 29)
+        self.assertEqual(parse_size('2T'), 2 << 40)
+
+    def test_not_set(self):
+        self.assertEqual(parse_size(''), 0)
+        self.assertEqual(parse_size(None), 0)
+
+    def test_bad_input(self):
+        for value in ('lots', '12X', 'M', '1.5'):
+            self.assertRaises(ValueError, parse_size, value)
+
+
+class RuntimeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(RUNTIME.__init__)
+        self.addCleanup(setattr, profiling, 'PROFILE_DIR', profiling.PROFILE_DIR)
+
+    def test_defaults(self):
+        self.assertEqual(RUNTIME.batch(100), 100)
+        self.assertEqual(RUNTIME.cache(10), 10)
+        self.assertGreater(RUNTIME.workers, 0)
+
+    def test_configure(self):
+        limit = resource.getrlimit(resource.RLIMIT_DATA)
+        self.addCleanup(resource.setrlimit, resource.RLIMIT_DATA, limit)
+        profile = os.path.join(self.directory, 'profile')
+        RUNTIME.configure(jobs=3, batch_size=7, cache_size=11, max_memory=64 << 30, profile=profile)
+        self.assertEqual((RUNTIME.workers, RUNTIME.batch(100), RUNTIME.cache(10)), (3, 7, 11))
+        self.assertEqual(resource.getrlimit(resource.RLIMIT_DATA), (64 << 30, limit[1]))
+        self.assertTrue(os.path.isdir(profile))
+        self.assertEqual(profiling.PROFILE_DIR, profile)
+
+    def test_middleware_takes_runtime_options(self):
+        calls = []
+        cli = dispatcher()
+
+        @cli.command()
+        def hello(name=('n', '', 'name'), *args):
+            calls.append((name, args, RUNTIME.jobs, RUNTIME.batch_size))
+
+        hello.command(['--jobs', '3', '--batch-size', '7', '-n', 'x', 'arg'])
+        self.assertEqual(calls, [('x', ('arg',), 3, 7)])
+        self.assertEqual(RUNTIME.max_memory, 0)
+
+    def test_middleware_profiles_command(self):
+        profile = os.path.join(self.directory, 'profile')
+        result = runtime.middleware(lambda value: value * 2)(21, profile=profile)
+        self.assertEqual(result, 42)
+        self.assertEqual(os.listdir(profile), ['main-{0}.prof'.format(os.getpid())])
+
+
+if __name__ == '__main__':
+    unittest.main()
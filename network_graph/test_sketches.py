@@ -0,0 +1,58 @@
+import random
+import unittest
+
+from collections import Counter
+
+from sketches import CountMinSketch, EdgeSketch, HyperLogLog, TopK
+
+
+class CountMinSketchTest(unittest.TestCase):
+    def test_never_underestimates_and_merges(self):
+        rnd = random.Random(0)
+        counts = Counter(str(rnd.randint(0, 5000)) for _ in xrange(20000))
+        left, right = CountMinSketch(width=512), CountMinSketch(width=512)
+        for idx, (key, count) in enumerate(counts.iteritems()):
+            (left if idx % 2 else right).add(key, count)
+        merged = left.merge(right)
+        self.assertTrue(all(merged.estimate(key) >= count for key, count in counts.iteritems()))
+        self.assertRaises(ValueError, merged.merge, CountMinSketch(width=256))
+
+
+class HyperLogLogTest(unittest.TestCase):
+    def test_estimate_within_few_percent(self):
+        left, right = HyperLogLog(), HyperLogLog()
+        for idx in xrange(50000):
+            (left if idx % 3 else right).add(str(idx))
+        self.assertAlmostEqual(left.merge(right).count() / 50000.0, 1.0, delta=0.05)
+        self.assertAlmostEqual(HyperLogLog().count(), 0.0)
+
+
+class TopKTest(unittest.TestCase):
+    def test_keeps_heaviest_keys(self):
+        rnd = random.Random(1)
+        # Skewed stream, estimates are exact running counts
+        counts, top = Counter(), TopK(k=20)
+        for _ in xrange(30000):
+            key = str(int(rnd.paretovariate(1.2)))
+            counts[key] += 1
+            top.offer(key, counts[key])
+        self.assertEqual(len(top.heap), len(top.candidates))
+        expected = [count for _, count in counts.most_common(20)]
+        self.assertEqual([estimate for _, estimate in top.items()], expected)
+
+    def test_merge(self):
+        left, right = EdgeSketch(k=5), EdgeSketch(k=5)
+        for idx in xrange(10):
+            for _ in xrange(idx + 1):
+                (left if idx % 2 else right).add('10.0.0.1', '10.0.0.{0}'.format(idx))
+        edges = left.merge(right).edges()
+        self.assertEqual([weight for _, _, weight in edges], [10, 9, 8, 7, 6])
+        self.assertEqual(edges[0][:2], ('10.0.0.1', '10.0.0.9'))
+        # Heap is consistent after merge
+        left.add('10.0.0.1', '10.0.0.100', 100)
+        self.assertEqual(left.edges()[0][2], 100)
+        self.assertEqual(len(left.edges()), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
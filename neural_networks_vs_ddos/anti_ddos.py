@@ -4,21 +4,17 @@
 import re
 import logging
 
-from itertools import chain
+from itertools import imap
 from collections import namedtuple
-
-from pybrain.datasets            import ClassificationDataSet
-from pybrain.utilities           import percentError
-from pybrain.tools.shortcuts     import buildNetwork
-from pybrain.supervised.trainers import BackpropTrainer
-from pybrain.structure.modules   import SoftmaxLayer, SigmoidLayer, LinearLayer
-
-from pybrain.tools.xml.networkwriter import NetworkWriter
+from contextlib import contextmanager
+from functools import partial
 
 import numpy as np
 from itertools import permutations
 
 from backports import lfu_cache
+from external import ExternalAggregator
+from runtime import RUNTIME, dispatcher
 from urlparse import urlparse, parse_qs
 
 from cPickle import dump, load
@@ -27,6 +23,12 @@ LogEntry = namedtuple('LogEntry', 'ip url code size refer useragent')
 log = logging.getLogger('')
 log.setLevel(logging.DEBUG)
 
+nginx_log_re = re.compile(r'(?P<ip>[0-9.:a-f]+) [^ ]+ [^ ]+ \[.*\] "(?P<url>.*)" (?P<code>[0-9]+) (?P<size>[0-9]+) "(?P<refer>.*)" "(?P<useragent>.*)"$')
+# Default number of log lines per worker task
+BATCH_SIZE = 1000
+# Feature -> column of feature vector, set in worker processes
+COLUMNS = None
+
 def normalize_request(req):
     vectors = []
     if req == '-':
@@ -119,65 +121,114 @@ def features_from_entry(entry):
     return request | refer | useragent | code
 
 
-def vector_from_entry(dictionary, entry):
-    return np.array([item in features_from_entry(entry) for item in dictionary])
+def parse_line(line):
+    """Returns LogEntry of nginx log line or None if it is malformed"""
+    try:
+        return LogEntry(*nginx_log_re.match(line).groups())
+    except Exception:
+        log.error('Failed to parse line: {0}'.format(line), exc_info=True)
+        return None
+
+
+def line_features(line):
+    """Returns features of nginx log line, empty set if it is malformed"""
+    entry = parse_line(line)
+    return features_from_entry(entry) if entry else set()
+
+
+def set_columns(columns):
+    global COLUMNS
+    COLUMNS = columns
+
+
+def line_columns(line):
+    """Returns feature vector columns which are set for log line, None if it is malformed"""
+    entry = parse_line(line)
+    if entry is None:
+        return None
+    return [COLUMNS[feature] for feature in features_from_entry(entry) if feature in COLUMNS]
+
+
+@contextmanager
+def line_mapper(initializer=None, initargs=()):
+    """
+    Returns ordered imap running in --jobs worker processes, lines are sent
+    to them in --batch-size chunks. With one job it runs in this process.
+    """
+    if RUNTIME.workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield imap
+        return
+    pool = RUNTIME.pool(initializer=initializer, initargs=initargs)
+    try:
+        yield partial(pool.imap, chunksize=RUNTIME.batch(BATCH_SIZE))
+    finally:
+        pool.close()
+        pool.join()
 
 
-def add_samples_to_training_set(training_set, file_name, label):
+def add_samples_to_training_set(imap_lines, training_set, file_name, label):
     with open(file_name) as file_:
-        for line in file_:
-            try:
-                entry = LogEntry(*nginx_log_re.match(line).groups())
-                training_set.addSample(list(vector_from_entry(dictionary, entry)), label)
-            except Exception:
-                log.error('Failed to parse line: {0}'.format(line), exc_info=True)
-
-
-if __name__ == '__main__':
-    from optparse import OptionParser
-    parser = OptionParser()
-    parser.add_option("-g", "--good", dest="good_file",
-                              help="nginx combined access log with good clients. For example access log before DDoS", metavar="FILE")
-    parser.add_option("-b", "--bad", dest="bad_file",
-                              help="nginx combined access log with bots' requests.", metavar="FILE")
-    parser.add_option("-l", "--log", dest="log_file",
-                              help="nginx combined access log for classification.", metavar="FILE")
-    (options, args) = parser.parse_args()
-
-    nginx_log_re = re.compile(r'(?P<ip>[0-9.:a-f]+) [^ ]+ [^ ]+ \[.*\] "(?P<url>.*)" (?P<code>[0-9]+) (?P<size>[0-9]+) "(?P<refer>.*)" "(?P<useragent>.*)"$')
+        for columns in imap_lines(line_columns, file_):
+            if columns is None:
+                continue
+            vector = np.zeros(training_set.indim)
+            vector[columns] = 1
+            training_set.addSample(vector, label)
+
+
+def build_dictionary(file_names, min_count=1):
+    """
+    Returns sorted list of features seen in at least ``min_count`` lines of
+    files. Feature counts are aggregated in memory budget, spilling to disk.
+    """
+    with ExternalAggregator() as vocabulary:
+        with line_mapper() as imap_lines:
+            for file_name in file_names:
+                with open(file_name) as file_:
+                    for features in imap_lines(line_features, file_):
+                        vocabulary.update((feature, 1) for feature in features)
+        if vocabulary.spills:
+            log.warning('Vocabulary spilled to disk {0} times'.format(vocabulary.spills))
+        return [feature for feature, count in vocabulary.items() if count >= min_count]
+
+
+def run(good_file, bad_file, log_file, tries=10, epochs=10, verbose=True, fast=False, bias=True, min_count=1):
+    """Trains networks on good and bad clients' logs and prints classification of clients in log_file"""
+    from pybrain.datasets            import ClassificationDataSet
+    from pybrain.utilities           import percentError
+    from pybrain.tools.shortcuts     import buildNetwork
+    from pybrain.supervised.trainers import BackpropTrainer
+    from pybrain.structure.modules   import SoftmaxLayer, SigmoidLayer
+
+    from pybrain.tools.xml.networkwriter import NetworkWriter
+
+    if RUNTIME.cache_size:
+        for cached in (normalize_url, normalize_refer, normalize_ua, features_from_entry):
+            cached.maxsize = RUNTIME.cache_size
 
     log.warning('Preparing dictionary')
-    dictionary = set()
-    with open(options.good_file) as good_file:
-        with open(options.bad_file) as bad_file:
-            for line in chain(good_file, bad_file):
-                try: 
-                    entry = LogEntry(*nginx_log_re.match(line).groups())
-                    dictionary |= features_from_entry(entry)
-                except Exception:
-                    log.error('Failed to parse line: {0}'.format(line), exc_info=True)
+    dictionary = build_dictionary((good_file, bad_file), min_count=min_count)
     log.warning('Feature vector size: {0}'.format(len(dictionary)))
     dump(dictionary, open('dictionary.p', 'wb'))
 
     log.warning('Adding Samples')
     alldata = ClassificationDataSet(len(dictionary), 1, nb_classes=2, class_labels=['good','bad'])
     np.random.shuffle(alldata)
-    add_samples_to_training_set(alldata, options.good_file, 0)
-    add_samples_to_training_set(alldata, options.bad_file, 1)
-    
+    nginx_log = ClassificationDataSet(len(dictionary), 1, nb_classes=2)
+    columns = dict((feature, column) for column, feature in enumerate(dictionary))
+    with line_mapper(set_columns, (columns,)) as imap_lines:
+        add_samples_to_training_set(imap_lines, alldata, good_file, 0)
+        add_samples_to_training_set(imap_lines, alldata, bad_file, 1)
+        add_samples_to_training_set(imap_lines, nginx_log, log_file, 0)
+
     log.warning('Preparing data...')
     trndata, tstdata = alldata.splitWithProportion(0.70)
 
     for data in [trndata, tstdata]:
         data._convertToOneOfMany()
 
-    # TODO(SaveTheRbtz@): Move to OptionParser
-    tries = 10
-    epochs = 10
-    verbose = True
-    fast = False
-    bias = True
-
     previous_error = 100
     for _ in xrange(tries):
         log.warning('Constructing NeuralNetwork...')
@@ -200,16 +251,14 @@ if __name__ == '__main__':
     NetworkWriter.writeToFile(fnn, 'nn.xml')
 
     log.warning('Activating NeuralNetwork...')
-    nginx_log = ClassificationDataSet(len(dictionary), 1, nb_classes=2)
-    add_samples_to_training_set(nginx_log, options.log_file, 0)
     nginx_log._convertToOneOfMany()  # this is still needed to make the fnn feel comfy
 
     out = fnn.activateOnDataset(nginx_log)
     out = out.argmax(axis=1)  # the highest output activation gives the class
 
-    with open(options.log_file) as log_file:
+    with open(log_file) as lines:
         cnt = 0
-        for line in log_file:
+        for line in lines:
             try:
                 entry = LogEntry(*nginx_log_re.match(line).groups())
                 if out[cnt]:
@@ -220,3 +269,24 @@ if __name__ == '__main__':
                 cnt += 1
             except Exception:
                 log.error('Failed to parse line: {0}'.format(line), exc_info=True)
+
+
+cli = dispatcher()
+
+@cli.command(usage='-g FILE -b FILE -l FILE [OPTIONS]')
+def main(good=('g', '', 'nginx combined access log with good clients. For example access log before DDoS'),
+         bad=('b', '', "nginx combined access log with bots' requests."),
+         log=('l', '', 'nginx combined access log for classification.'),
+         tries=('t', 10, 'number of networks to train, the one with the lowest test error is used'),
+         epochs=('e', 10, 'number of training epochs of every network'),
+         quiet=('q', False, "don't print training progress"),
+         fast=('', False, 'build networks with fast arac implementation'),
+         no_bias=('', False, 'build networks without bias units'),
+         min_count=('', 1, 'drop features seen in fewer lines of good and bad logs')):
+    """Classify clients of nginx log as good or bots with neural network"""
+    run(good, bad, log, tries=tries, epochs=epochs, verbose=not quiet, fast=fast, bias=not no_bias,
+        min_count=min_count)
+
+
+if __name__ == '__main__':
+    main.command()
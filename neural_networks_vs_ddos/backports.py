@@ -90,7 +90,7 @@ def lfu_cache(maxsize=100):
 
     Arguments to the cached function must be hashable.
     Cache performance statistics stored in f.hits and f.misses.
-    Clear the cache with f.clear().
+    Clear the cache with f.clear(), resize it by setting f.maxsize.
     http://en.wikipedia.org/wiki/Least_Frequently_Used
 
     '''
@@ -116,8 +116,8 @@ def lfu_cache(maxsize=100):
                 wrapper.misses += 1
 
                 # purge least frequently used cache entry
-                if len(cache) > maxsize:
-                    for key, _ in nsmallest(maxsize // 10,
+                if len(cache) > wrapper.maxsize:
+                    for key, _ in nsmallest(len(cache) - wrapper.maxsize * 9 // 10,
                                             use_count.iteritems(),
                                             key=itemgetter(1)):
                         del cache[key], use_count[key]
@@ -130,6 +130,7 @@ def lfu_cache(maxsize=100):
             wrapper.hits = wrapper.misses = 0
 
         wrapper.hits = wrapper.misses = 0
+        wrapper.maxsize = maxsize
         wrapper.clear = clear
         return wrapper
     return decorating_function
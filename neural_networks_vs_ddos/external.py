@@ -0,0 +1 @@
+../network_graph/external.py
\ No newline at end of file
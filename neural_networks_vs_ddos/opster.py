@@ -0,0 +1 @@
+../network_graph/opster.py
\ No newline at end of file
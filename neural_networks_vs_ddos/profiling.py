@@ -0,0 +1 @@
+../network_graph/profiling.py
\ No newline at end of file
@@ -0,0 +1,25 @@
+import unittest
+
+import anti_ddos
+from runtime import RUNTIME
+
+
+class MiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(RUNTIME.__init__)
+        self.addCleanup(setattr, anti_ddos, 'run', anti_ddos.run)
+        self.calls = []
+        anti_ddos.run = lambda *args, **kwargs: self.calls.append((args, kwargs, RUNTIME.jobs, RUNTIME.cache_size))
+
+    def test_runtime_options_are_taken_off_command(self):
+        anti_ddos.main.command(['-g', 'good.log', '-b', 'bad.log', '-l', 'access.log', '-t', '2',
+                                '--jobs', '4', '--cache-size', '100'])
+        self.assertEqual(len(self.calls), 1)
+        args, kwargs, jobs, cache_size = self.calls[0]
+        self.assertEqual(args, ('good.log', 'bad.log', 'access.log'))
+        self.assertEqual(kwargs['tries'], 2)
+        self.assertEqual((jobs, cache_size), (4, 100))
+
+
+if __name__ == '__main__':
+    unittest.main()